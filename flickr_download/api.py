@@ -0,0 +1,291 @@
+"""Hooks into the request path of flickr_api.
+
+flickr_api sends every API request through `method_call._make_request_with_retry`. `install()`
+replaces that function with one that does the same, but also lets the rest of the tool observe
+every HTTP request made (including the retries), and holds the requests to an hourly budget.
+It also wraps `method_call.call_api`, to answer repeated calls about the same photo from memory,
+and to count the calls of every API method.
+
+Responses served from the flickr_api cache and the transfers of the photos themselves do not go
+through here, and do not count against the budget.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from flickr_api import method_call
+from flickr_api import retry as retry_module
+
+from flickr_download.cache import pack_value, unpack_value
+from flickr_download.sessions import get_session
+from flickr_download.stats import ApiStats
+
+# Called with the API method, the HTTP status (None if the request failed altogether) and the
+# duration of the request in seconds
+RequestObserver = Callable[[str, Optional[int], float], None]
+
+_OBSERVERS: List[RequestObserver] = []
+_OBSERVERS_LOCK = threading.Lock()
+
+_STATS = ApiStats()
+
+# Flickr allows roughly this many API calls per hour and key
+DEFAULT_CALLS_PER_HOUR = 3600
+
+# Number of photos between two reports of the remaining budget
+BUDGET_REPORT_INTERVAL = 100
+
+# Share of the hourly budget that can be spent in a burst
+BUDGET_BURST = 1 / 60
+
+
+class ApiBudget:
+    """Token bucket holding the API requests to an hourly budget.
+
+    The bucket only holds a minute's worth of calls (BUDGET_BURST), and refills continuously
+    with the rest of the hourly budget, so that no hour, the first one included, has more calls
+    than the budget. It also keeps track of the number of calls spent per photo, to estimate how
+    many photos the remaining budget covers.
+    """
+
+    def __init__(self, calls_per_hour: int) -> None:
+        """
+        :param calls_per_hour: number of API calls allowed per hour
+        """
+        self.calls_per_hour = calls_per_hour
+        self.calls = 0
+        self.photos = 0
+        # At least one call at a time, unless that is a large part of the budget
+        self._capacity = min(max(1.0, calls_per_hour * BUDGET_BURST), calls_per_hour / 2)
+        self._rate = (calls_per_hour - self._capacity) / 3600.0
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """Take one call from the budget, waiting for it to refill if needed."""
+        with self._lock:
+            self._refill()
+            # Take the token right away, callers waiting on an empty bucket queue up behind
+            # each other by driving it further below zero
+            self._tokens -= 1
+            self.calls += 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            logging.debug("API budget used up, waiting %.1fs", wait)
+            time.sleep(wait)
+
+    def remaining(self) -> int:
+        """Number of calls that can be made over the next hour."""
+        with self._lock:
+            self._refill()
+            return max(0, int(self._tokens + self._rate * 3600))
+
+    def note_photo(self) -> None:
+        """Count a photo towards the calls per photo, reporting the budget now and then."""
+        with self._lock:
+            self.photos += 1
+            report = self.photos % BUDGET_REPORT_INTERVAL == 0
+        if report:
+            logging.info("%s", self.status())
+
+    def photos_covered(self) -> Optional[int]:
+        """Estimate how many more photos can be processed over the next hour, or None if
+        unknown.
+        """
+        if not self.photos or not self.calls:
+            return None
+        return int(self.remaining() * self.photos / self.calls)
+
+    def status(self) -> str:
+        """Describe the remaining budget."""
+        status = (
+            f"API budget: {self.remaining()} of {self.calls_per_hour} calls left for the next hour"
+        )
+        covered = self.photos_covered()
+        if covered is None:
+            return status
+        per_photo = self.calls / self.photos
+        per_hour = int(self.calls_per_hour / per_photo)
+        return (
+            f"{status}, enough for about {covered} more photos and {per_hour} photos per hour "
+            f"after that ({per_photo:.1f} calls per photo)"
+        )
+
+
+_BUDGET: Optional[ApiBudget] = None
+
+# API methods about a single photo, whose answers are reused for the whole run
+MEMOIZED_METHODS = {"flickr.photos.getInfo", "flickr.photos.getSizes", "flickr.photos.getExif"}
+
+# Maximum size in bytes of the (compressed) answers kept in memory
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+
+# Arguments of call_api that do not change the answer
+_UNKEYED_ARGS = {"api_key", "api_secret", "auth_handler"}
+
+
+class CallMemo:
+    """Wraps call_api to remember the answers about single photos for the whole run.
+
+    flickr_api only keeps the sizes and info of a photo on the Photo object, but a photo in
+    several sets comes up as a new object in every set. Unlike the --cache, nothing is kept
+    between runs. The answers are kept compressed, up to max_bytes.
+    """
+
+    def __init__(self, call_api: Callable[..., Any], max_bytes: int = MEMO_MAX_BYTES) -> None:
+        """
+        :param call_api: the function making the API calls
+        :param max_bytes: maximum size of the compressed answers to keep, the least recently
+            used ones are dropped first
+        """
+        self.call_api = call_api
+        self.max_bytes = max_bytes
+        self.saved = 0
+        self._answers: "OrderedDict[Tuple[Any, ...], bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, **args: Any) -> Any:
+        if args.get("method") not in MEMOIZED_METHODS:
+            return self.call_api(**args)
+
+        key = tuple(sorted((k, repr(v)) for k, v in args.items() if k not in _UNKEYED_ARGS))
+        with self._lock:
+            data = self._answers.get(key)
+            if data is not None:
+                self._answers.move_to_end(key)
+                self.saved += 1
+        if data is not None:
+            _STATS.count_memo_hit(str(args["method"]))
+            # A fresh copy, as flickr_api modifies the answers while turning them into objects
+            return unpack_value(data)
+
+        answer = self.call_api(**args)
+        data = pack_value(answer)
+        with self._lock:
+            previous = self._answers.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._answers[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                self._bytes -= len(self._answers.popitem(last=False)[1])
+        return answer
+
+
+_MEMO: Optional[CallMemo] = None
+
+
+class CountedCall:
+    """Wraps call_api to count the calls of every API method, and the errors."""
+
+    def __init__(self, call_api: Callable[..., Any]) -> None:
+        """
+        :param call_api: the function making the API calls
+        """
+        self.call_api = call_api
+
+    def __call__(self, **args: Any) -> Any:
+        method = str(args.get("method", ""))
+        try:
+            answer = self.call_api(**args)
+        except Exception:
+            _STATS.count_call(method, error=True)
+            raise
+        _STATS.count_call(method, error=False)
+        return answer
+
+
+def install() -> None:
+    """Route the API requests of flickr_api through this module."""
+    global _MEMO  # pylint: disable=global-statement
+    if not isinstance(method_call.call_api, CountedCall):
+        _MEMO = CallMemo(method_call.call_api)
+        method_call.call_api = CountedCall(_MEMO)  # type: ignore[assignment]
+
+    if not hasattr(method_call, "_make_request_with_retry"):
+        logging.warning("Unsupported flickr_api version, API requests will not be tracked")
+        return
+    method_call._make_request_with_retry = _make_request_with_retry
+
+
+def set_budget(calls_per_hour: Optional[int]) -> None:
+    """Hold the API requests to a budget of calls per hour (None or 0 for no limit)."""
+    global _BUDGET  # pylint: disable=global-statement
+    _BUDGET = ApiBudget(calls_per_hour) if calls_per_hour else None
+
+
+def get_budget() -> Optional[ApiBudget]:
+    """The budget the API requests are held to, if any."""
+    return _BUDGET
+
+
+def get_stats() -> ApiStats:
+    """The counters of the API calls of the run."""
+    return _STATS
+
+
+def get_memo() -> Optional[CallMemo]:
+    """The memo of the API calls about single photos, once installed."""
+    return _MEMO
+
+
+def note_photo() -> None:
+    """Count a photo processed, for the estimates of the budget."""
+    if _BUDGET:
+        _BUDGET.note_photo()
+
+
+def add_request_observer(observer: RequestObserver) -> None:
+    """Register a function to be called after every API request."""
+    with _OBSERVERS_LOCK:
+        _OBSERVERS.append(observer)
+
+
+def remove_request_observer(observer: RequestObserver) -> None:
+    """Unregister a function registered with add_request_observer."""
+    with _OBSERVERS_LOCK:
+        _OBSERVERS.remove(observer)
+
+
+def _notify(method: str, status: Optional[int], seconds: float) -> None:
+    _STATS.count_request(method, status, seconds)
+    with _OBSERVERS_LOCK:
+        observers = list(_OBSERVERS)
+    for observer in observers:
+        observer(method, status, seconds)
+
+
+def _make_request_with_retry(
+    request_url: str, args: Dict[str, Any], oauth_auth: Any
+) -> requests.Response:
+    """Replacement for `method_call._make_request_with_retry`."""
+    method = str(args.get("method", ""))
+    method_call._init_retry_module()
+    _STATS.count_fetch(method)
+
+    def make_request() -> requests.Response:
+        if _BUDGET:
+            _BUDGET.acquire()
+        start = time.monotonic()
+        try:
+            resp = get_session().post(
+                request_url, args, auth=oauth_auth, timeout=method_call.get_timeout()
+            )
+        except requests.RequestException:
+            _notify(method, None, time.monotonic() - start)
+            raise
+        _notify(method, resp.status_code, time.monotonic() - start)
+        return resp
+
+    return retry_module.retry_request(make_request, operation_name="API call")
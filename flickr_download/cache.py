@@ -0,0 +1,335 @@
+"""Persistent cache of the API responses, kept in SQLite.
+
+`SqliteCache` has the same interface as flickr_api's SimpleCache (the Django low-level cache
+API), so it goes behind `Flickr.enable_cache`. Unlike a pickled SimpleCache, every entry is
+written as it is added, and opening the cache does not read it all into memory. Entries are
+stored compressed, and the cache is bounded by the size of the entries.
+
+Several processes can share the same cache file: each reads what the others wrote, and writes
+wait for each other instead of overwriting the file. The file has to be on a local disk though,
+SQLite locking is not reliable over network file systems.
+"""
+
+import hashlib
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Default number of seconds before an entry expires
+DEFAULT_TIMEOUT = 3600
+
+DAY = 24 * 3600
+
+# Number of seconds before the responses of an API method expire, by method. The sizes and EXIF
+# of a photo practically never change, its info rarely, while listings change all the time.
+DEFAULT_TTLS = {
+    "flickr.photos.getSizes": 30 * DAY,
+    "flickr.photos.getExif": 30 * DAY,
+    "flickr.photos.getInfo": DAY,
+    "flickr.photosets.getInfo": DAY,
+    "flickr.people.getInfo": DAY,
+    "flickr.photosets.getPhotos": 600,
+    "flickr.photosets.getList": 600,
+    "flickr.people.getPhotos": 600,
+}
+
+# Default maximum size of the (compressed) entries in bytes, the least recently used ones are
+# evicted first
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Version of the format of the entries, caches in another format are emptied when opened
+CACHE_FORMAT = 1
+
+# Number of seconds to wait for other processes writing to the cache, before giving up on a read
+# or write
+BUSY_TIMEOUT = 30.0
+
+# Number of entries added between two evictions of the expired and least recently used entries
+EVICT_INTERVAL = 500
+
+_SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Arguments of the API calls that do not change the response: the API key, the response format,
+# and the OAuth signing (nonce, timestamp, signature...)
+_NOISE_ARGS = {"api_key", "api_sig", "format", "nojsoncallback"}
+
+
+def pack_value(value: Any) -> bytes:
+    """Serialize and compress a value to keep in a cache."""
+    return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_value(data: bytes) -> Any:
+    """Turn data from pack_value back into the value."""
+    return pickle.loads(zlib.decompress(data))
+
+
+def is_cacheable(value: Any) -> bool:
+    """Checks whether a value can be cached.
+
+    flickr_api caches a response before checking it. Errors (HTTP errors, or stat=fail like
+    code 105, service currently unavailable) are mostly transient, and must not be kept for as
+    long as the answer would be.
+    """
+    status = getattr(value, "status_code", None)
+    if status is None:
+        return True
+    if status != 200:
+        return False
+    try:
+        data = value.json()
+    except ValueError:
+        # Not a JSON response
+        return True
+    return not isinstance(data, dict) or data.get("stat") == "ok"
+
+
+def normalize_key(key: str) -> str:
+    """Turn the cache key of flickr_api into one that only depends on the API method, its
+    arguments, and who is authenticated.
+
+    flickr_api makes the key from all the arguments of the request. Signed requests come with a
+    new nonce, timestamp and signature every time, and the order of the arguments can vary.
+
+    :param key: the cache key flickr_api uses, the URL encoded arguments of the call
+    """
+    args = urllib.parse.parse_qsl(key, keep_blank_values=True)
+    semantic = sorted(
+        (name, value)
+        for name, value in args
+        if name not in _NOISE_ARGS and not name.startswith("oauth_")
+    )
+    token = dict(args).get("oauth_token")
+    if token:
+        # Who is authenticated changes the response (private photos), but there is no need to
+        # keep the token itself around
+        semantic.append(("user", hashlib.sha256(token.encode()).hexdigest()[:16]))
+    return urllib.parse.urlencode(semantic)
+
+
+class SqliteCache:
+    """Cache of API responses in an SQLite database (in WAL mode).
+
+    Safe to use from several threads and processes. Each entry expires on its own, after a time
+    depending on the API method, and the least recently used entries are evicted once the
+    entries take more than max_bytes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        timeout: int = DEFAULT_TIMEOUT,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttls: Optional[Dict[str, int]] = None,
+    ) -> None:
+        """
+        :param path: the database file, created if missing
+        :param timeout: default number of seconds before an entry expires
+        :param max_bytes: maximum size of the compressed entries
+        :param ttls: number of seconds before an entry expires by API method, overriding
+            DEFAULT_TTLS
+        """
+        self.path = path
+        self.default_timeout = timeout
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._added = 0
+        self._hits: "Counter[str]" = Counter()
+        self._misses: "Counter[str]" = Counter()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Another process may be setting up the same file
+        self._conn.execute("BEGIN IMMEDIATE")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_FORMAT:
+            if version:
+                logging.info("Emptying the cache, as it is from another version")
+            self._conn.execute("DROP TABLE IF EXISTS cache")
+            self._conn.execute(f"PRAGMA user_version = {CACHE_FORMAT}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache"
+            " (key text PRIMARY KEY, value blob, size integer, expires real, accessed real)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Fetch a given key from the cache, or default if missing or expired."""
+        method = _get_method(key)
+        key = normalize_key(key)
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT value, expires FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.OperationalError as ex:
+                # Do without the cache this time
+                logging.warning("Could not read from the cache: %s", ex)
+                row = None
+            if row is not None and row[1] < now:
+                self._write("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._misses[method] += 1
+                return default
+            self._hits[method] += 1
+            self._write("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return unpack_value(row[0])
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> None:
+        """Set a value in the cache.
+
+        :param key: the key
+        :param value: the value, anything that can be pickled
+        :param timeout: number of seconds before the entry expires, by default depending on the
+            API method of the response
+        """
+        if not is_cacheable(value):
+            return
+        now = time.time()
+        expires = now + (self.get_timeout(key) if timeout is None else timeout)
+        self._put(normalize_key(key), pack_value(value), expires, now)
+
+    def get_timeout(self, key: str) -> int:
+        """Number of seconds before the response for the given key expires.
+
+        :param key: the cache key flickr_api uses, the URL encoded arguments of the call
+        """
+        return self.ttls.get(_get_method(key), self.default_timeout)
+
+    def hit_ratios(self) -> List[Tuple[str, int, int]]:
+        """Returns the number of hits and lookups of the cache by API method, since opened."""
+        with self._lock:
+            methods = sorted(set(self._hits) | set(self._misses))
+            return [
+                (method, self._hits[method], self._hits[method] + self._misses[method])
+                for method in methods
+            ]
+
+    def _put(self, key: str, data: bytes, expires: float, accessed: float) -> None:
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), expires, accessed),
+            )
+            self._added += 1
+            if self._added % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _write(self, sql: str, parameters: Tuple[Any, ...]) -> None:
+        try:
+            self._conn.execute(sql, parameters)
+            self._conn.commit()
+        except sqlite3.OperationalError as ex:
+            # Most likely held up by other processes for longer than BUSY_TIMEOUT, nothing
+            # depends on a single write making it
+            logging.warning("Could not write to the cache: %s", ex)
+            self._conn.rollback()
+
+    def _evict(self) -> None:
+        self._write("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        # Keep the most recently used entries that fit in max_bytes
+        self._write(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM"
+            " (SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM cache)"
+            " WHERE total > ?)",
+            (self.max_bytes,),
+        )
+
+    def delete(self, key: str) -> None:
+        """Delete a key from the cache, failing silently."""
+        with self._lock:
+            self._write("DELETE FROM cache WHERE key = ?", (normalize_key(key),))
+
+    def has_key(self, key: str) -> bool:
+        """Returns True if the key is in the cache and has not expired."""
+        return self.get(key) is not None
+
+    def __contains__(self, key: str) -> bool:
+        return self.has_key(key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0])
+
+    def close(self) -> None:
+        """Evict the expired and least recently used entries, and close the database."""
+        with self._lock:
+            self._evict()
+            self._conn.close()
+
+    def import_pickle(self, path: str) -> int:
+        """Import the entries of a cache pickled by older versions of flickr_download.
+
+        :param path: the pickled cache
+        :returns: the number of entries imported
+        """
+        with open(path, "rb") as handle:
+            database = pickle.load(handle)
+
+        now = time.time()
+        imported = 0
+        for key, value in database["storage"].items():
+            expires = database["expire_info"].get(key, 0)
+            if expires < now:
+                continue
+            self._put(
+                normalize_key(key),
+                pack_value(value),
+                expires,
+                now,
+            )
+            imported += 1
+        return imported
+
+
+def open_cache(
+    path: str, ttls: Optional[Dict[str, int]] = None, max_bytes: int = DEFAULT_MAX_BYTES
+) -> SqliteCache:
+    """Open the cache at the given path.
+
+    A cache pickled by older versions of flickr_download is imported, and kept next to it with
+    a .pickle suffix.
+
+    :param path: the cache file
+    :param ttls: number of seconds before an entry expires by API method, overriding
+        DEFAULT_TTLS
+    :param max_bytes: maximum size of the compressed entries
+    """
+    cache_path = Path(path)
+    if not cache_path.exists() or _is_sqlite(cache_path):
+        return SqliteCache(path, ttls=ttls, max_bytes=max_bytes)
+
+    backup = cache_path.with_name(cache_path.name + ".pickle")
+    try:
+        cache_path.rename(backup)
+    except FileNotFoundError:
+        # Another process got to import it first
+        return SqliteCache(path, ttls=ttls, max_bytes=max_bytes)
+    cache = SqliteCache(path, ttls=ttls, max_bytes=max_bytes)
+    try:
+        imported = cache.import_pickle(str(backup))
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError) as ex:
+        logging.warning("Could not import the old cache %s: %s", backup, ex)
+        return cache
+    logging.info("Imported %d entries from the old cache, now kept as %s", imported, backup)
+    return cache
+
+
+def _get_method(key: str) -> str:
+    return urllib.parse.parse_qs(key).get("method", [""])[0]
+
+
+def _is_sqlite(path: Path) -> bool:
+    with path.open("rb") as handle:
+        return handle.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
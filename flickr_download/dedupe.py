@@ -0,0 +1,103 @@
+"""Index of the photos downloaded to any directory, to link photos in several sets.
+
+A photo in several sets is placed in the directory of every set. With an index, only the first
+placement transfers the photo, the others link to that file.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+# File name of the index, in the directory the sets are downloaded to
+INDEX_FILE = ".photo_index.db"
+
+# Ways of linking to a photo downloaded before
+LINK_MODES = ["hardlink", "symlink"]
+
+
+class PhotoIndex:
+    """Index of the files photos were downloaded to, by photo and size.
+
+    Safe to use from several threads. The index lives in an SQLite database, so it is kept
+    between runs and can be shared by processes downloading to the same directory.
+    """
+
+    def __init__(self, path: str, mode: str = "hardlink") -> None:
+        """
+        :param path: the database file, created if missing
+        :param mode: how to link to a photo downloaded before, see LINK_MODES
+        """
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode: {mode}")
+        self.mode = mode
+        self.linked = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS photos"
+            " (photo_id text, size_label text, path text, PRIMARY KEY (photo_id, size_label))"
+        )
+        self._conn.commit()
+
+    def find(self, photo_id: str, size_label: Optional[str]) -> Optional[str]:
+        """Returns the file the photo was downloaded to, if it is still there."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM photos WHERE photo_id = ? AND size_label = ?",
+                (photo_id, size_label or ""),
+            ).fetchone()
+        if row is None or not os.path.isfile(row[0]):
+            return None
+        return str(row[0])
+
+    def add(self, photo_id: str, size_label: Optional[str], path: str) -> None:
+        """Record the file a photo was downloaded to."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO photos VALUES (?, ?, ?)",
+                (photo_id, size_label or "", os.path.abspath(path)),
+            )
+            self._conn.commit()
+
+    def link(self, source: str, target: str) -> bool:
+        """Place a photo downloaded before at the given file name.
+
+        :param source: the file the photo was downloaded to
+        :param target: the file to create
+        :returns: whether the link was made, it fails for example for hard links across file
+            systems
+        """
+        try:
+            if self.mode == "hardlink":
+                os.link(source, target)
+            else:
+                os.symlink(
+                    os.path.relpath(source, os.path.dirname(os.path.abspath(target))), target
+                )
+        except OSError as ex:
+            logging.debug("Could not link %s to %s: %s", target, source, ex)
+            return False
+        with self._lock:
+            self.linked += 1
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_INDEX: Optional[PhotoIndex] = None
+
+
+def set_index(index: Optional[PhotoIndex]) -> None:
+    """Link photos downloaded before using the given index (None to download them again)."""
+    global _INDEX  # pylint: disable=global-statement
+    _INDEX = index
+
+
+def get_index() -> Optional[PhotoIndex]:
+    """The index photos downloaded before are linked from, if any."""
+    return _INDEX
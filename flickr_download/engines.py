@@ -0,0 +1,588 @@
+"""Engines that run photo downloads concurrently.
+
+A photo download is split in two steps: resolving it (API calls for the photo info and sizes,
+working out the file name and whether it needs downloading at all) and transferring it (fetching
+the image and writing it to disk). The engines take the functions for the two steps and differ
+only in how they schedule them.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from urllib.parse import urlparse
+
+from flickr_api.method_call import REST_URL
+from flickr_api.objects import Photo
+
+from flickr_download.api import add_request_observer, remove_request_observer
+from flickr_download.transfer import SavedFile, add_transfer_observer, remove_transfer_observer
+
+API_HOST = urlparse(REST_URL).netloc
+
+T = TypeVar("T")
+
+
+class Resolved(NamedTuple):
+    """A resolved photo.
+
+    :param fname: the file name the photo is saved to
+    :param url: the URL to fetch the photo from, or None if the file is already in place
+    """
+
+    fname: str
+    url: Optional[str]
+
+
+# Outcome of a photo download: whether the photo is now in place on disk, or the file it was just
+# saved to
+Downloaded = Union[bool, SavedFile]
+
+ResolveFunc = Callable[[Photo, str, Optional[str], bool, bool], Optional[Resolved]]
+TransferFunc = Callable[[Photo, Resolved, Optional[str]], Downloaded]
+
+
+class Engine(Protocol):
+    """Interface of the download engines."""
+
+    @property
+    def max_in_flight(self) -> int:
+        """How many photos the caller should keep submitted at most."""
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        """Schedule the download of a photo.
+
+        :returns: future for the outcome of the download
+        """
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        """Schedule a blocking API call under the concurrency limits of the engine.
+
+        :returns: future for the result of the call
+        """
+
+    def shutdown(self, cancel: bool = False) -> None:
+        """Wait for the scheduled downloads and release the resources of the engine.
+
+        :param cancel: cancel the scheduled downloads not started yet instead, when giving up on
+            them after an error or an interruption
+        """
+
+
+class ThreadEngine:
+    """Runs each photo download as a single task on a pool of worker threads."""
+
+    def __init__(self, resolve: ResolveFunc, transfer: TransferFunc, workers: int) -> None:
+        """
+        :param resolve: function resolving a photo
+        :param transfer: function transferring a resolved photo
+        :param workers: number of worker threads
+        """
+        self.max_in_flight = 2 * workers
+        self._resolve = resolve
+        self._transfer = transfer
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        return self._executor.submit(
+            self._download, photo, fname, size_label, skip_download, save_json
+        )
+
+    def _download(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> Downloaded:
+        resolved = self._resolve(photo, fname, size_label, skip_download, save_json)
+        if resolved is None:
+            return False
+        if resolved.url is None:
+            return True
+        return self._transfer(photo, resolved, size_label)
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        return self._executor.submit(func, *args)
+
+    def shutdown(self, cancel: bool = False) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+
+
+class AsyncEngine:
+    """Runs photo downloads as tasks on a single asyncio event loop.
+
+    The event loop holds all the photos in flight, and caps the number of concurrent requests
+    to each host (the API host and the image hosts). flickr_api is synchronous, so the blocking
+    calls themselves run on a thread pool that is only as large as the caps for the API host and
+    one image host, no matter how many photos are in flight.
+    """
+
+    def __init__(
+        self,
+        resolve: ResolveFunc,
+        transfer: TransferFunc,
+        per_host: int,
+        max_in_flight: int = 1000,
+    ) -> None:
+        """
+        :param resolve: function resolving a photo
+        :param transfer: function transferring a resolved photo
+        :param per_host: maximum number of concurrent requests to one host
+        :param max_in_flight: maximum number of photos in flight
+        """
+        self.max_in_flight = max_in_flight
+        self._resolve = resolve
+        self._transfer = transfer
+        self._per_host = per_host
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._executor = ThreadPoolExecutor(max_workers=2 * per_host, thread_name_prefix="async")
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="engine", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        return asyncio.run_coroutine_threadsafe(
+            self._download(photo, fname, size_label, skip_download, save_json), self._loop
+        )
+
+    def _host_limit(self, host: str) -> asyncio.Semaphore:
+        # Only ever called on the event loop thread
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self._per_host)
+        return self._host_limits[host]
+
+    async def _download(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> Downloaded:
+        loop = asyncio.get_running_loop()
+        async with self._host_limit(API_HOST):
+            resolved = await loop.run_in_executor(
+                None, self._resolve, photo, fname, size_label, skip_download, save_json
+            )
+        if resolved is None:
+            return False
+        if resolved.url is None:
+            return True
+
+        async with self._host_limit(urlparse(resolved.url).netloc):
+            return await loop.run_in_executor(None, self._transfer, photo, resolved, size_label)
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        return asyncio.run_coroutine_threadsafe(self._call(func, *args), self._loop)
+
+    async def _call(self, func: Callable[..., T], *args: Any) -> T:
+        async with self._host_limit(API_HOST):
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def shutdown(self, cancel: bool = False) -> None:
+        async def drain() -> None:
+            current = asyncio.current_task()
+            tasks = [t for t in asyncio.all_tasks() if t is not current]
+            if cancel:
+                # The blocking calls already running still run to their end on the executor
+                for task in tasks:
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(drain(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown(wait=not cancel, cancel_futures=cancel)
+
+
+class StageStats:
+    """Statistics for one stage of a PipelineEngine."""
+
+    def __init__(self, name: str, workers: int, queue_size: int) -> None:
+        """
+        :param name: name of the stage
+        :param workers: number of worker threads of the stage
+        :param queue_size: size of the queue feeding the stage
+        """
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.processed = 0
+        self.busy = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def queued(self, depth: int) -> None:
+        """Record the depth of the queue after an item was added to it."""
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def done(self, busy: float) -> None:
+        """Record an item processed by the stage, keeping a worker busy for `busy` seconds."""
+        with self._lock:
+            self.processed += 1
+            self.busy += busy
+
+    def summary(self, elapsed: float) -> str:
+        """Returns a one line summary of the stage.
+
+        :param elapsed: seconds the pipeline has been running
+        """
+        elapsed = max(elapsed, 1e-9)
+        return (
+            f"{self.name} stage: {self.processed} items, "
+            f"{self.processed / elapsed:.1f}/s, "
+            f"{100 * self.busy / (elapsed * self.workers):.0f}% of {self.workers} workers busy, "
+            f"max queue depth {self.max_queue_depth}/{self.queue_size}"
+        )
+
+
+_ResolveJob = Tuple["Future[Any]", Callable[[], Any], Optional[Photo], Optional[str]]
+_TransferJob = Tuple["Future[Downloaded]", Photo, Resolved, Optional[str]]
+
+
+class PipelineEngine:
+    """Runs photo downloads as a pipeline of a resolve stage and a transfer stage.
+
+    Each stage has its own worker threads, and the stages are connected by bounded queues. That
+    way the latency bound API calls of the resolve stage overlap with the bandwidth bound
+    transfers, and each stage can be sized on its own. The queue depths and the throughput of the
+    stages are logged when the engine is shut down.
+    """
+
+    def __init__(
+        self,
+        resolve: ResolveFunc,
+        transfer: TransferFunc,
+        resolve_workers: int,
+        transfer_workers: int,
+    ) -> None:
+        """
+        :param resolve: function resolving a photo
+        :param transfer: function transferring a resolved photo
+        :param resolve_workers: number of worker threads of the resolve stage
+        :param transfer_workers: number of worker threads of the transfer stage
+        """
+        self._resolve = resolve
+        self._transfer = transfer
+        self._resolve_queue: "queue.Queue[Optional[_ResolveJob]]" = queue.Queue(2 * resolve_workers)
+        self._transfer_queue: "queue.Queue[Optional[_TransferJob]]" = queue.Queue(
+            2 * transfer_workers
+        )
+        self.resolve_stats = StageStats("Resolve", resolve_workers, 2 * resolve_workers)
+        self.transfer_stats = StageStats("Transfer", transfer_workers, 2 * transfer_workers)
+        self.max_in_flight = 3 * (resolve_workers + transfer_workers)
+        self._started = time.monotonic()
+        self._cancelled = False
+        self._resolve_threads = self._start(self._run_resolve, resolve_workers, "resolve")
+        self._transfer_threads = self._start(self._run_transfer, transfer_workers, "transfer")
+
+    @staticmethod
+    def _start(target: Callable[[], None], count: int, name: str) -> List[threading.Thread]:
+        threads = [
+            threading.Thread(target=target, name=f"{name}_{i}", daemon=True) for i in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        future: "Future[Downloaded]" = Future()
+        func = partial(self._resolve, photo, fname, size_label, skip_download, save_json)
+        self._put(self._resolve_queue, self.resolve_stats, (future, func, photo, size_label))
+        return future
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        future: "Future[T]" = Future()
+        self._put(
+            self._resolve_queue, self.resolve_stats, (future, partial(func, *args), None, None)
+        )
+        return future
+
+    @staticmethod
+    def _put(work_queue: "queue.Queue[Any]", stats: StageStats, job: Any) -> None:
+        work_queue.put(job)
+        stats.queued(work_queue.qsize())
+
+    @staticmethod
+    def _cancel_queued(work_queue: "queue.Queue[Any]") -> None:
+        while not work_queue.empty():
+            job = work_queue.get_nowait()
+            if job:
+                job[0].cancel()
+
+    def _run_resolve(self) -> None:
+        while True:
+            job = self._resolve_queue.get()
+            if job is None:
+                return
+            future, func, photo, size_label = job
+            if self._cancelled:
+                future.cancel()
+                continue
+            start = time.monotonic()
+            try:
+                result = func()
+            except BaseException as ex:
+                future.set_exception(ex)
+                continue
+            finally:
+                self.resolve_stats.done(time.monotonic() - start)
+
+            if photo is None:
+                # A plain API call
+                future.set_result(result)
+            elif result is None:
+                future.set_result(False)
+            elif result.url is None:
+                future.set_result(True)
+            else:
+                self._put(
+                    self._transfer_queue, self.transfer_stats, (future, photo, result, size_label)
+                )
+
+    def _run_transfer(self) -> None:
+        while True:
+            job = self._transfer_queue.get()
+            if job is None:
+                return
+            future, photo, resolved, size_label = job
+            if self._cancelled:
+                future.cancel()
+                continue
+            start = time.monotonic()
+            try:
+                future.set_result(self._transfer(photo, resolved, size_label))
+            except BaseException as ex:
+                future.set_exception(ex)
+            finally:
+                self.transfer_stats.done(time.monotonic() - start)
+
+    def shutdown(self, cancel: bool = False) -> None:
+        # With cancel, the jobs still queued are dropped by the workers
+        self._cancelled = cancel
+        for _ in self._resolve_threads:
+            self._resolve_queue.put(None)
+        for thread in self._resolve_threads:
+            thread.join()
+        for _ in self._transfer_threads:
+            self._transfer_queue.put(None)
+        for thread in self._transfer_threads:
+            thread.join()
+        if cancel:
+            # Jobs still put by other threads while the workers were stopping
+            self._cancel_queued(self._resolve_queue)
+            self._cancel_queued(self._transfer_queue)
+
+        elapsed = time.monotonic() - self._started
+        logging.info("%s", self.resolve_stats.summary(elapsed))
+        logging.info("%s", self.transfer_stats.summary(elapsed))
+
+
+class SharedEngine:
+    """An engine shared by several photo lists downloading at the same time.
+
+    Every list gets an equal share of the photos the engine can have in flight, so a large list
+    doesn't hold up the small ones, and a large list left on its own gets the whole engine.
+    Shutting down the shared engine is left to the owner of the underlying one.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        """
+        :param engine: the engine to share
+        """
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._active = 0
+        self._stopped = False
+
+    def stop(self) -> None:
+        """Stop the lists using the engine: anything they schedule from now on raises
+        CancelledError.
+        """
+        self._stopped = True
+
+    def _check_stopped(self) -> None:
+        if self._stopped:
+            raise CancelledError()
+
+    @property
+    def max_in_flight(self) -> int:
+        return max(1, self.engine.max_in_flight // max(1, self._active))
+
+    @contextmanager
+    def attach(self) -> Iterator["SharedEngine"]:
+        """Context manager for a list using the engine while in the block."""
+        with self._lock:
+            self._active += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        self._check_stopped()
+        return self.engine.submit(photo, fname, size_label, skip_download, save_json)
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        self._check_stopped()
+        return self.engine.call(func, *args)
+
+    def shutdown(self, cancel: bool = False) -> None:
+        pass
+
+
+class AdaptiveEngine:
+    """Wraps an engine, adapting the number of photos in flight to how well Flickr copes.
+
+    The limit is controlled AIMD style from the outcome of the API requests and of the transfer
+    requests, as most photos need no API request of their own. It starts at one and doubles
+    every round trip until the first backoff (slow start), and from then on grows by one per
+    round trip. Requests taking much longer than the fastest seen for the same API method (or
+    the same host, for transfers) hold the limit where it is. Throttling (HTTP 429), server
+    errors (HTTP 5xx) and failed requests halve it, at most once per cooldown period as errors
+    come in bursts.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        latency_factor: float = 4.0,
+        cooldown: float = 2.0,
+        maximum: Optional[int] = None,
+    ) -> None:
+        """
+        :param engine: the engine to wrap
+        :param latency_factor: how many times slower than the fastest request for the same API
+            method or host a request can be before the limit stops growing
+        :param cooldown: minimum number of seconds between two backoffs
+        :param maximum: upper bound for the limit, by default the max_in_flight of the engine.
+            For an engine keeping many more photos in flight than it runs at once, the number it
+            runs at once, or backing off has no effect.
+        """
+        self.engine = engine
+        self._maximum = min(maximum or engine.max_in_flight, engine.max_in_flight)
+        self._latency_factor = latency_factor
+        self._cooldown = cooldown
+        self._limit = 1.0
+        self._slow_start = True
+        self._last_backoff = 0.0
+        self._fastest: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        add_request_observer(self.observe)
+        add_transfer_observer(self.observe)
+
+    @property
+    def max_in_flight(self) -> int:
+        return int(self._limit)
+
+    def observe(self, method: str, status: Optional[int], seconds: float) -> None:
+        """Adjust the limit after an API request or a transfer request.
+
+        :param method: the API method called, or the host of a transfer
+        :param status: HTTP status of the response, or None if the request failed
+        :param seconds: duration of the request (until the response, for a transfer)
+        """
+        with self._lock:
+            if status is None or status == 429 or status >= 500:
+                now = time.monotonic()
+                if now - self._last_backoff >= self._cooldown:
+                    self._last_backoff = now
+                    self._slow_start = False
+                    self._limit = max(1.0, self._limit / 2)
+                    logging.debug(
+                        "Backing off to %d downloads in flight after HTTP %s on %s",
+                        self._limit,
+                        status,
+                        method,
+                    )
+                return
+            if status >= 400:
+                return
+
+            fastest = self._fastest.get(method, seconds)
+            self._fastest[method] = min(fastest, seconds)
+            if seconds > self._latency_factor * fastest:
+                return
+            increase = 1.0 if self._slow_start else 1.0 / self._limit
+            self._limit = min(float(self._maximum), self._limit + increase)
+
+    def submit(
+        self,
+        photo: Photo,
+        fname: str,
+        size_label: Optional[str],
+        skip_download: bool,
+        save_json: bool,
+    ) -> "Future[Downloaded]":
+        return self.engine.submit(photo, fname, size_label, skip_download, save_json)
+
+    def call(self, func: Callable[..., T], *args: Any) -> "Future[T]":
+        return self.engine.call(func, *args)
+
+    def shutdown(self, cancel: bool = False) -> None:
+        remove_request_observer(self.observe)
+        remove_transfer_observer(self.observe)
+        self.engine.shutdown(cancel)
+        logging.info(
+            "Adaptive concurrency settled at %d downloads in flight (of at most %d)",
+            self.max_in_flight,
+            self._maximum,
+        )
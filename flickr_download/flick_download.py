@@ -3,13 +3,19 @@
 
 import argparse
 import errno
+import hashlib
+import itertools
 import json
 import logging
 import os
+import re
+import signal
 import sqlite3
 import sys
+import threading
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import flickr_api as Flickr
 import yaml
@@ -17,6 +23,19 @@ from flickr_api.flickrerrors import FlickrAPIError, FlickrError
 from flickr_api.objects import Person, Photo, Photoset, Walker
 
 import flickr_download
+from flickr_download import api, sessions, transfer
+from flickr_download.cache import DEFAULT_MAX_BYTES, SqliteCache
+from flickr_download.dedupe import INDEX_FILE, LINK_MODES, PhotoIndex, get_index, set_index
+from flickr_download.engines import (
+    AdaptiveEngine,
+    AsyncEngine,
+    Downloaded,
+    Engine,
+    PipelineEngine,
+    Resolved,
+    SharedEngine,
+    ThreadEngine,
+)
 from flickr_download.filename_handlers import (
     FilenameHandler,
     get_filename_handler,
@@ -24,19 +43,53 @@ from flickr_download.filename_handlers import (
     get_filename_handler_names,
 )
 from flickr_download.logging_utils import APIKeysRedacter
+from flickr_download.transfer import PART_SUFFIX, SavedFile, download_file
 from flickr_download.utils import (
     get_dirname,
     get_full_path,
     get_photo_page,
     init_cache,
-    save_cache,
     serialize_json,
     set_file_time,
 )
+from flickr_download.verify import BAD_SUFFIX, FileCheck, check_files
+from flickr_download.walker import PrefetchWalker
 
 CONFIG_FILE = "~/.flickr_download"
 OAUTH_TOKEN_FILE = "~/.flickr_token"
 
+MB = 1024 * 1024
+
+# Version of the schema of the metadata store, kept in its user_version
+METADATA_SCHEMA_VERSION = 2
+
+# Downloads are written to the metadata store in batches of this many records, or this many
+# seconds, whichever comes first
+METADATA_COMMIT_RECORDS = 100
+METADATA_COMMIT_SECONDS = 5.0
+
+# Codes of the photo sizes in the url_* extras of photo listings, by size label
+SIZE_CODES = {
+    "Square": "sq",
+    "Large Square": "q",
+    "Thumbnail": "t",
+    "Small": "s",
+    "Small 320": "n",
+    "Medium": "m",
+    "Medium 640": "z",
+    "Medium 800": "c",
+    "Large": "l",
+    "Large 1600": "h",
+    "Large 2048": "k",
+    "Original": "o",
+}
+
+# A shard of a sharded download: (K, N) for the Kth shard out of N, counting from 1
+Shard = Tuple[int, int]
+
+# A download recorded in the metadata store: (photo_id, size_label, suffix)
+DownloadKey = Tuple[str, str, Optional[str]]
+
 
 def _init(key: str, secret: str, oauth: bool) -> bool:
     """Initialize API.
@@ -48,6 +101,7 @@ def _init(key: str, secret: str, oauth: bool) -> bool:
     :param oauth: do user authentication (via OAuth)
     """
     Flickr.set_keys(key, secret)
+    api.install()
     if not oauth:
         return True
 
@@ -93,14 +147,384 @@ def _load_defaults() -> Dict[str, Any]:
     return {}
 
 
-def _get_metadata_db(dirname: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(Path(dirname) / ".metadata.db")
+class MetadataDb(sqlite3.Connection):
+    """Connection to a metadata store, writing the downloads recorded in batches.
+
+    The records are kept in memory until their batch is due, and each batch is written in a
+    short transaction of its own, on a connection used for nothing else. That way other
+    connections to the store are never kept waiting for a batch to fill. A batch is also written
+    once its time is up even when no new record comes.
+
+    Closing the connection writes the pending records, and commits.
+    """
+
+    def __init__(self, database: Any, *args: Any, **kwargs: Any) -> None:
+        super().__init__(database, *args, **kwargs)
+        self._database = database
+        self._timeout = kwargs.get("timeout", 5.0)
+        self._writer: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._downloads: Set[DownloadKey] = set()
+        self._files: Dict[DownloadKey, Tuple[str, int, Optional[str]]] = {}
+
+    def record(
+        self, key: DownloadKey, saved: Optional[Tuple[str, int, Optional[str]]] = None
+    ) -> None:
+        """Record a download, and the file it was saved to if known, with the next batch."""
+        with self._lock:
+            self._downloads.add(key)
+            if saved:
+                self._files[key] = saved
+            due = len(self._downloads) >= METADATA_COMMIT_RECORDS
+            if not due and not self._timer:
+                self._timer = threading.Timer(METADATA_COMMIT_SECONDS, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def has_pending(self, key: DownloadKey) -> bool:
+        """Whether a download is recorded, but not written yet."""
+        with self._lock:
+            return key in self._downloads
+
+    def flush(self) -> None:
+        """Write the pending records."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._downloads:
+                return
+            if not self._writer:
+                self._writer = sqlite3.connect(
+                    self._database,
+                    timeout=self._timeout,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                self._writer.executemany(
+                    "INSERT OR IGNORE INTO downloads VALUES (?, ?, ?)", self._downloads
+                )
+                self._writer.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    [key + saved for key, saved in self._files.items()],
+                )
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+            self._downloads.clear()
+            self._files.clear()
+
+    def _flush_on_timer(self) -> None:
+        try:
+            self.flush()
+        except sqlite3.Error as ex:
+            # Kept for the next batch
+            logging.warning("Could not write the downloads to the metadata store: %s", ex)
+
+    def close(self) -> None:
+        # The writer would wait for the transaction of this connection otherwise
+        self.commit()
+        self.flush()
+        if self._writer:
+            self._writer.close()
+        super().close()
+
+
+def _get_metadata_db(dirname: str, shard: Optional[Shard] = None) -> MetadataDb:
+    """Open the metadata store of a directory, creating or migrating it as needed."""
+    conn = sqlite3.connect(
+        Path(dirname) / _get_metadata_db_name(shard), timeout=30.0, factory=MetadataDb
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("BEGIN IMMEDIATE")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
     conn.execute(
         "CREATE TABLE IF NOT EXISTS downloads (photo_id text, size_label text, suffix text)"
     )
+    if version < 1:
+        # Stores from before the schema was versioned have no index, and may hold the same
+        # download more than once
+        conn.execute(
+            "DELETE FROM downloads WHERE rowid NOT IN"
+            " (SELECT MIN(rowid) FROM downloads GROUP BY photo_id, size_label, suffix)"
+        )
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS downloads_key"
+            " ON downloads (photo_id, size_label, suffix)"
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sync_state"
+        " (source text, size_label text, suffix text, max_upload_date integer,"
+        " PRIMARY KEY (source, size_label, suffix))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS album_state"
+        " (set_id text, size_label text, suffix text, fingerprint text,"
+        " PRIMARY KEY (set_id, size_label, suffix))"
+    )
+    # The files downloads were saved to (relative to the directory), to verify them. Added in
+    # version 2, downloads recorded before have none.
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files"
+        " (photo_id text, size_label text, suffix text, path text, size integer, sha256 text,"
+        " PRIMARY KEY (photo_id, size_label, suffix))"
+    )
+    if version < METADATA_SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version = {METADATA_SCHEMA_VERSION}")
+    conn.commit()
     return conn
 
 
+class SkipSet:
+    """What is already downloaded to a directory, loaded once before downloading a photo list.
+
+    That way photos downloaded before are skipped without a query to the metadata store, or
+    without asking Flickr for the file extension to check the file on disk.
+    """
+
+    def __init__(
+        self, downloads: Optional[Set[DownloadKey]] = None, files: Optional[Set[str]] = None
+    ) -> None:
+        """
+        :param downloads: the downloads recorded in the metadata store
+        :param files: the names of the files in the directory
+        """
+        self.downloads = downloads or set()
+        self.files = files
+
+    @classmethod
+    def from_metadata_db(cls, metadata_db: sqlite3.Connection) -> "SkipSet":
+        """Load the downloads recorded in a metadata store."""
+        if isinstance(metadata_db, MetadataDb):
+            metadata_db.flush()
+        rows = metadata_db.execute("SELECT photo_id, size_label, suffix FROM downloads")
+        return cls(downloads={(str(row[0]), row[1], row[2]) for row in rows})
+
+    @classmethod
+    def from_directory(cls, dirname: str) -> "SkipSet":
+        """List the photos in a directory.
+
+        The .json files with the photo info do not count, they are saved before the photo, and
+        neither do the partial downloads.
+        """
+        files = set()
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith((".json", PART_SUFFIX)):
+                    files.add(entry.name)
+        return cls(files=files)
+
+    def has_download(self, photo: Photo, size_label: Optional[str], suffix: Optional[str]) -> bool:
+        """Checks whether the photo is recorded as downloaded."""
+        return (str(photo.id), size_label or "", suffix) in self.downloads
+
+    def has_file(self, fname: str, extension: Optional[str]) -> bool:
+        """Checks whether the directory listing has the file a photo is saved to.
+
+        :param fname: the file name from the filename handler
+        :param extension: the extension flickr_api adds to the file name if it has none, if
+            known (see _get_listing_extension)
+        """
+        if self.files is None:
+            return False
+        name = os.path.basename(fname)
+        if os.path.splitext(name)[1]:
+            # Like for a title with a dot in it, the name is used as it is
+            return name in self.files
+        return extension is not None and name + extension in self.files
+
+    def add(self, photo: Photo, size_label: Optional[str], suffix: Optional[str]) -> None:
+        """Record a photo as downloaded."""
+        self.downloads.add((str(photo.id), size_label or "", suffix))
+
+
+class FilesInFlight:
+    """The files photos are being downloaded to, by all the photo lists downloading at once.
+
+    Two photos can get the same file name, for example with duplicate titles, or in two sets of
+    the same title. A serial download saves the first of them, and skips the others as existing
+    already. A parallel download does the same by only starting a photo once no other photo is
+    being downloaded to its file.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Set once the download to the file ends, by file name
+        self._files: Dict[str, threading.Event] = {}
+
+    def claim(self, fname: str) -> None:
+        """Wait until no photo is being downloaded to the file, and claim it."""
+        while True:
+            with self._lock:
+                released = self._files.get(fname)
+                if released is None:
+                    self._files[fname] = threading.Event()
+                    return
+            released.wait()
+
+    def release(self, fname: str) -> None:
+        """Release a file claimed before."""
+        with self._lock:
+            self._files.pop(fname).set()
+
+    def release_when_done(self, fname: str, future: "Future[Any]") -> None:
+        """Release a file claimed before once the download to it ends."""
+        future.add_done_callback(lambda _: self.release(fname))
+
+
+_FILES_IN_FLIGHT = FilesInFlight()
+
+
+def _get_metadata_db_name(shard: Optional[Shard] = None) -> str:
+    """Returns the file name of the metadata store.
+
+    Every shard of a sharded download has its own metadata store, so that processes downloading
+    to the same directory don't race on it.
+    """
+    if shard:
+        return f".metadata.shard-{shard[0]}-of-{shard[1]}.db"
+    return ".metadata.db"
+
+
+def _get_metadata_db_shards(dirname: str) -> List[Optional[Shard]]:
+    """Returns the shards of the metadata stores in a directory, None for the regular one."""
+    shards: List[Optional[Shard]] = []
+    for path in sorted(Path(dirname).glob(".metadata*.db")):
+        match = re.fullmatch(r"\.metadata\.shard-(\d+)-of-(\d+)\.db", path.name)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2))))
+        elif path.name == _get_metadata_db_name():
+            shards.append(None)
+    return shards
+
+
+def _in_shard(photo: Photo, shard: Optional[Shard]) -> bool:
+    """Checks whether the photo belongs to the given shard (all do if not sharding)."""
+    if not shard:
+        return True
+    digest = hashlib.sha1(str(photo.id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard[1] == shard[0] - 1
+
+
+def _is_downloaded(
+    metadata_db: sqlite3.Connection, photo: Photo, size_label: Optional[str], suffix: Optional[str]
+) -> bool:
+    """Checks whether the metadata store has a record of the photo being downloaded."""
+    key = (photo.id, size_label or "", suffix)
+    if isinstance(metadata_db, MetadataDb) and metadata_db.has_pending(key):
+        return True
+    return (
+        metadata_db.execute(
+            "SELECT 1 FROM downloads WHERE photo_id = ? AND size_label = ? AND suffix = ?", key
+        ).fetchone()
+        is not None
+    )
+
+
+def _record_download(
+    metadata_db: sqlite3.Connection,
+    photo: Photo,
+    size_label: Optional[str],
+    suffix: Optional[str],
+    downloaded: Downloaded = True,
+) -> None:
+    """Records a downloaded photo in the metadata store, with the file it was saved to if
+    transferred just now.
+
+    With a MetadataDb the record is written with the next batch.
+
+    :param downloaded: the outcome of the download of the photo
+    """
+    key = (photo.id, size_label or "", suffix)
+    saved = None
+    if isinstance(downloaded, SavedFile):
+        saved = (os.path.basename(downloaded.path), downloaded.size, downloaded.sha256)
+    if isinstance(metadata_db, MetadataDb):
+        metadata_db.record(key, saved)
+        return
+    metadata_db.execute("INSERT OR IGNORE INTO downloads VALUES (?, ?, ?)", key)
+    if saved:
+        metadata_db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", key + saved)
+    metadata_db.commit()
+
+
+def _get_upload_watermark(
+    metadata_db: sqlite3.Connection, source: str, size_label: Optional[str], suffix: Optional[str]
+) -> Optional[int]:
+    """Returns the upload date of the newest photo of a complete download of the list, if any."""
+    row = metadata_db.execute(
+        "SELECT max_upload_date FROM sync_state WHERE source = ? AND size_label = ? AND suffix = ?",
+        (source, size_label or "", suffix),
+    ).fetchone()
+    return int(row[0]) if row else None
+
+
+def _set_upload_watermark(
+    metadata_db: sqlite3.Connection,
+    source: str,
+    size_label: Optional[str],
+    suffix: Optional[str],
+    max_upload_date: int,
+) -> None:
+    """Records the upload date of the newest photo of a complete download of the list."""
+    metadata_db.execute(
+        "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+        (source, size_label or "", suffix, max_upload_date),
+    )
+    metadata_db.commit()
+
+
+def _get_album_fingerprint(pset: Union[Photoset, Person]) -> Optional[str]:
+    """Returns the fingerprint of a photo set from the user's list of sets.
+
+    Adding, removing or reordering photos changes the last update of the set. The number of
+    photos and videos also catches photos deleted from Flickr altogether.
+
+    :returns: the fingerprint, or None if the set does not come from the list of sets
+    """
+    date_update = pset.get("date_update")
+    if not date_update:
+        return None
+    return f"{pset.get('photos', 0)}/{pset.get('videos', 0)}/{date_update}"
+
+
+def _is_album_unchanged(
+    metadata_db: sqlite3.Connection,
+    set_id: str,
+    size_label: Optional[str],
+    suffix: Optional[str],
+    fingerprint: str,
+) -> bool:
+    """Checks whether the set is the same as at its last complete download."""
+    row = metadata_db.execute(
+        "SELECT fingerprint FROM album_state WHERE set_id = ? AND size_label = ? AND suffix = ?",
+        (set_id, size_label or "", suffix),
+    ).fetchone()
+    return bool(row and row[0] == fingerprint)
+
+
+def _record_album(
+    metadata_db: sqlite3.Connection,
+    set_id: str,
+    size_label: Optional[str],
+    suffix: Optional[str],
+    fingerprint: str,
+) -> None:
+    """Records the fingerprint of a set at a complete download."""
+    metadata_db.execute(
+        "INSERT OR REPLACE INTO album_state VALUES (?, ?, ?, ?)",
+        (set_id, size_label or "", suffix, fingerprint),
+    )
+    metadata_db.commit()
+
+
 def download_set(
     set_id: str,
     get_filename: FilenameHandler,
@@ -108,6 +532,12 @@ def download_set(
     skip_download: bool = False,
     save_json: bool = False,
     metadata_store: Optional[bool] = None,
+    workers: int = 1,
+    engine: str = "sync",
+    resolve_workers: Optional[int] = None,
+    prefetch_pages: Optional[int] = 0,
+    shard: Optional[Shard] = None,
+    adaptive: bool = False,
 ) -> None:
     """Download the set with 'set_id' to the current directory.
 
@@ -116,10 +546,31 @@ def download_set(
     :param size_label: size to download (or None for largest available)
     :param skip_download: do not actually download the photo
     :param save_json: save photo info as .json file
+    :param workers: number of photos to download in parallel
+    :param engine: download engine to use for parallel downloads, "sync", "async" or "pipeline"
+    :param resolve_workers: number of resolve workers for the "pipeline" engine (defaults to
+        workers)
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param shard: only download the given shard of the photos
+    :param adaptive: adapt the number of photos in flight to how Flickr copes, up to what the
+        workers allow
     """
     pset = Flickr.Photoset(id=set_id)
     download_list(
-        pset, pset.title, get_filename, size_label, skip_download, save_json, metadata_store
+        pset,
+        pset.title,
+        get_filename,
+        size_label,
+        skip_download,
+        save_json,
+        metadata_store,
+        workers,
+        engine,
+        resolve_workers,
+        prefetch_pages,
+        shard,
+        adaptive,
     )
 
 
@@ -131,6 +582,14 @@ def download_list(
     skip_download: bool = False,
     save_json: bool = False,
     metadata_store: Optional[bool] = None,
+    workers: int = 1,
+    engine: Union[str, Engine] = "sync",
+    resolve_workers: Optional[int] = None,
+    prefetch_pages: Optional[int] = 0,
+    shard: Optional[Shard] = None,
+    adaptive: bool = False,
+    incremental: bool = False,
+    skip_unchanged: bool = False,
 ) -> None:
     """Download all the photos in the given photo list.
 
@@ -140,9 +599,50 @@ def download_list(
     :param size_label: size to download (or None for largest available)
     :param skip_download: do not actually download the photo
     :param save_json: save photo info as .json file
+    :param workers: number of photos to download in parallel
+    :param engine: download engine to use for parallel downloads, "sync", "async" or
+        "pipeline", or an engine shared with other photo lists
+    :param resolve_workers: number of resolve workers for the "pipeline" engine (defaults to
+        workers)
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param shard: only download the given shard of the photos
+    :param adaptive: adapt the number of photos in flight to how Flickr copes, up to what the
+        workers allow
+    :param incremental: only list the photos uploaded since the last complete download of the
+        list (needs metadata_store, and a photo list supporting min_upload_date)
+    :param skip_unchanged: skip a set that has not changed since its last complete download
+        (needs metadata_store, and a set from the user's list of sets)
     """
-
-    photos: Walker[Photo] = Walker(pset.getPhotos)
+    if isinstance(engine, str):
+        # A sharded download assigns file names by itself, which only the engines do
+        if workers > 1 or engine != "sync" or shard:
+            own_engine = _get_engine(engine, workers, resolve_workers, adaptive)
+            try:
+                download_list(
+                    pset,
+                    photos_title,
+                    get_filename,
+                    size_label,
+                    skip_download,
+                    save_json,
+                    metadata_store,
+                    workers,
+                    own_engine,
+                    prefetch_pages=prefetch_pages,
+                    shard=shard,
+                    incremental=incremental,
+                    skip_unchanged=skip_unchanged,
+                )
+            except BaseException:
+                # Giving up on the photos not started yet
+                own_engine.shutdown(cancel=True)
+                raise
+            own_engine.shutdown()
+            return
+        download_engine = None
+    else:
+        download_engine = engine
 
     suffix = f" ({size_label})" if size_label else ""
 
@@ -151,6 +651,9 @@ def download_list(
     if not os.path.exists(dirname):
         try:
             os.mkdir(dirname)
+        except FileExistsError:
+            # Created by another list downloading at the same time
+            pass
         except OSError as err:
             if err.errno == errno.ENAMETOOLONG:
                 logging.warning("WARNING: Truncating too long directory name: %s", dirname)
@@ -158,29 +661,271 @@ def download_list(
                 # length in an OS-agnostic way... Assuming that most OSes can handle at least 200
                 # chars...
                 dirname = str(dirname)[:200]
-                os.mkdir(dirname)
+                os.makedirs(dirname, exist_ok=True)
             else:
                 raise
 
     conn = None
     if metadata_store:
-        conn = _get_metadata_db(str(dirname))
+        conn = _get_metadata_db(str(dirname), shard)
 
-    for photo in photos:
-        do_download_photo(
-            dirname,
-            pset,
-            photo,
-            size_label,
-            suffix,
-            get_filename,
-            skip_download,
-            save_json,
-            metadata_db=conn,
+    try:
+        # A shard only downloads part of the list, so it cannot tell when the list is complete
+        fingerprint = (
+            _get_album_fingerprint(pset) if conn and skip_unchanged and not shard else None
         )
+        if conn and fingerprint:
+            if _is_album_unchanged(conn, pset.id, size_label, suffix, fingerprint):
+                logging.info(
+                    "Skipping %s, as it is unchanged since the last download", photos_title
+                )
+                return
+
+        # Without the metadata store, only the files can tell what is downloaded already, but the
+        # .json files would need checking too
+        skip_set = None
+        if conn:
+            skip_set = SkipSet.from_metadata_db(conn)
+        elif not save_json:
+            skip_set = SkipSet.from_directory(str(dirname))
+
+        incremental = bool(incremental and conn and not shard)
+        since = (
+            _get_upload_watermark(conn, pset.id, size_label, suffix)
+            if conn and incremental
+            else None
+        )
+        if since:
+            logging.info("Only listing photos uploaded since the last complete download")
+
+        if download_engine:
+            # Fetching the first page of the listing counts against the budget of the engine too
+            photos = download_engine.call(
+                _walk_photos, pset, size_label, prefetch_pages, since
+            ).result()
+        else:
+            photos = _walk_photos(pset, size_label, prefetch_pages, since)
+
+        newest = since or 0
+
+        def track_newest(photos: Iterable[Photo]) -> Iterator[Photo]:
+            nonlocal newest
+            for photo in photos:
+                newest = max(newest, int(photo.get("dateupload") or 0))
+                yield photo
+
+        if incremental:
+            photos = track_newest(photos)
+
+        if download_engine:
+            complete = _download_photos_parallel(
+                dirname,
+                pset,
+                photos,
+                size_label,
+                suffix,
+                get_filename,
+                skip_download,
+                save_json,
+                conn,
+                download_engine,
+                shard,
+                skip_set,
+            )
+        else:
+            complete = True
+            for photo in photos:
+                if not do_download_photo(
+                    dirname,
+                    pset,
+                    photo,
+                    size_label,
+                    suffix,
+                    get_filename,
+                    skip_download,
+                    save_json,
+                    metadata_db=conn,
+                    skip_set=skip_set,
+                ):
+                    complete = False
+
+        if conn:
+            # Photos failing to download are listed again next time
+            if incremental and complete and newest:
+                _set_upload_watermark(conn, pset.id, size_label, suffix, newest)
+            if fingerprint and complete:
+                _record_album(conn, pset.id, size_label, suffix, fingerprint)
+    finally:
+        if conn:
+            conn.close()
+
+
+def _walk_photos(
+    pset: Union[Photoset, Person],
+    size_label: Optional[str],
+    prefetch_pages: Optional[int],
+    min_upload_date: Optional[int] = None,
+) -> Iterable[Photo]:
+    """Returns an iterator over all the photos in the photo list.
+
+    :param pset: the photo list
+    :param size_label: size to download (or None for largest available)
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param min_upload_date: only list the photos uploaded since then (unix time)
+    """
+    kwargs: Dict[str, Any] = {"extras": _get_listing_extras(size_label)}
+    if min_upload_date:
+        kwargs["min_upload_date"] = min_upload_date
+    if prefetch_pages == 0:
+        photos: Walker[Photo] = Walker(pset.getPhotos, **kwargs)
+        return photos
+    return PrefetchWalker(pset.getPhotos, prefetch=prefetch_pages, **kwargs)
+
+
+def _get_listing_extras(size_label: Optional[str]) -> str:
+    """Extras to request with the photo listings, so that photos can be downloaded without
+    fetching their info and sizes one by one.
 
-    if conn:
-        conn.close()
+    :param size_label: size to download (or None for largest available)
+    """
+    extras = ["media", "date_upload", "date_taken", "url_o"]
+    code = SIZE_CODES.get(size_label) if size_label else None
+    if code and code != "o":
+        extras.append(f"url_{code}")
+    return ",".join(extras)
+
+
+def _apply_listing_extras(photo: Photo, size_label: Optional[str]) -> None:
+    """Set the sizes of a photo from the extras of the listing it comes from.
+
+    The sizes are only set when the listing has the size to download, the original one being
+    the largest. Otherwise flickr.photos.getSizes is called as usual. Videos have no URLs in
+    the extras.
+
+    :param photo: photo from a listing
+    :param size_label: size to download (or None for largest available)
+    """
+    if photo.get("media") != "photo":
+        return
+    if not photo.get(f"url_{SIZE_CODES.get(size_label or 'Original')}"):
+        # people.getPhotos sets the sizes from the extras by itself, even if incomplete
+        photo.__dict__.pop("sizes", None)
+        return
+    photo.__dict__["sizes"] = {
+        label: {
+            "label": label,
+            "width": photo.get(f"width_{code}"),
+            "height": photo.get(f"height_{code}"),
+            "source": photo[f"url_{code}"],
+            "media": "photo",
+        }
+        for label, code in SIZE_CODES.items()
+        if photo.get(f"url_{code}")
+    }
+
+
+def _get_listing_extension(photo: Photo, size_label: Optional[str]) -> Optional[str]:
+    """The extension flickr_api adds to the file name of a photo without one, from the extras of
+    the listing the photo comes from.
+
+    :param photo: photo from a listing
+    :param size_label: size to download (or None for largest available)
+    :returns: the extension, or None if the listing does not tell
+    """
+    media = photo.get("media")
+    if media == "video":
+        return ".mp4"
+    if media != "photo":
+        return None
+    url = photo.get(f"url_{SIZE_CODES.get(size_label or 'Original')}")
+    return "." + url.split(".")[-1] if url else None
+
+
+def _get_taken(photo: Photo) -> Optional[str]:
+    """When the photo was taken, from its info or from the extras of its listing."""
+    if photo["loaded"]:
+        return photo["taken"]
+    return photo.get("datetaken")
+
+
+def _download_photos_parallel(
+    dirname: str,
+    pset: Union[Photoset, Person],
+    photos: Iterable[Photo],
+    size_label: Optional[str],
+    suffix: str,
+    get_filename: FilenameHandler,
+    skip_download: bool,
+    save_json: bool,
+    metadata_db: Optional[sqlite3.Connection],
+    engine: Engine,
+    shard: Optional[Shard] = None,
+    skip_set: Optional[SkipSet] = None,
+) -> bool:
+    """Download the photos using a download engine.
+
+    The metadata store and the filename handler are only used from the calling thread, and in
+    listing order, so the result on disk is the same as for a serial download.
+
+    When only downloading a shard of the photos, the file names are still assigned for all the
+    photos in the listing. That way the shards agree on the names, also for naming modes that
+    depend on the photos before (title_increment).
+
+    A photo saved to the same file name as a photo in flight waits for that one to be done, see
+    FilesInFlight.
+
+    :param engine: the engine to run the downloads on
+    :param shard: only download the given shard of the photos
+    :param skip_set: what is downloaded already, instead of asking the metadata store
+    :returns: whether all the photos (of the shard) are now in place on disk
+    """
+    pending: Dict[Future[Downloaded], Photo] = {}
+    complete = True
+
+    def collect(return_when: str) -> None:
+        nonlocal complete
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            photo = pending.pop(future)
+            downloaded = future.result()
+            if not downloaded:
+                complete = False
+                continue
+            if metadata_db:
+                _record_download(metadata_db, photo, size_label, suffix, downloaded)
+            if skip_set:
+                skip_set.add(photo, size_label, suffix)
+
+    for photo in photos:
+        name = get_filename(pset, photo, suffix) if shard else None
+        if not _in_shard(photo, shard):
+            continue
+
+        if _is_skipped(metadata_db, skip_set, photo, size_label, suffix):
+            logging.info("Skipping download of already downloaded photo with ID: %s", photo.id)
+            continue
+
+        if name is None:
+            name = get_filename(pset, photo, suffix)
+        fname = get_full_path(dirname, name)
+        if skip_set and skip_set.has_file(fname, _get_listing_extension(photo, size_label)):
+            logging.info("Skipping %s, as it exists already", fname)
+            continue
+        _FILES_IN_FLIGHT.claim(fname)
+        try:
+            future = engine.submit(photo, fname, size_label, skip_download, save_json)
+        except BaseException:
+            _FILES_IN_FLIGHT.release(fname)
+            raise
+        _FILES_IN_FLIGHT.release_when_done(fname, future)
+        pending[future] = photo
+        # Keep a bounded number of photos in flight, so we don't read ahead the whole listing
+        if len(pending) >= engine.max_in_flight:
+            collect(FIRST_COMPLETED)
+
+    collect(ALL_COMPLETED)
+    return complete
 
 
 def do_download_photo(
@@ -193,7 +938,8 @@ def do_download_photo(
     skip_download: bool = False,
     save_json: bool = False,
     metadata_db: Optional[sqlite3.Connection] = None,
-) -> None:
+    skip_set: Optional[SkipSet] = None,
+) -> bool:
     """Handle the downloading of a single photo.
 
     :param dirname: directory to download to
@@ -206,30 +952,98 @@ def do_download_photo(
     :param save_json: save photo info as .json file
     :param metadata_db: optional metadata database to record downloads
         in
+    :param skip_set: what is downloaded already, instead of asking the metadata store
+    :returns: whether the photo is now in place on disk
     """
-    if metadata_db:
-        if metadata_db.execute(
-            "SELECT * FROM downloads WHERE photo_id = ? AND size_label = ? AND suffix = ?",
-            (photo.id, size_label or "", suffix),
-        ).fetchone():
-            logging.info("Skipping download of already downloaded photo with ID: %s", photo.id)
-            return
+    if _is_skipped(metadata_db, skip_set, photo, size_label, suffix):
+        logging.info("Skipping download of already downloaded photo with ID: %s", photo.id)
+        return True
 
     fname = get_full_path(dirname, get_filename(pset, photo, suffix))
+    if skip_set and skip_set.has_file(fname, _get_listing_extension(photo, size_label)):
+        logging.info("Skipping %s, as it exists already", fname)
+        return True
+    downloaded = _process_photo(photo, fname, size_label, skip_download, save_json)
+    if not downloaded:
+        return False
+    if metadata_db:
+        _record_download(metadata_db, photo, size_label, suffix, downloaded)
+    if skip_set:
+        skip_set.add(photo, size_label, suffix)
+    return True
+
+
+def _is_skipped(
+    metadata_db: Optional[sqlite3.Connection],
+    skip_set: Optional[SkipSet],
+    photo: Photo,
+    size_label: Optional[str],
+    suffix: Optional[str],
+) -> bool:
+    """Checks whether the photo is recorded as downloaded, in the skip set if there is one."""
+    if skip_set:
+        return skip_set.has_download(photo, size_label, suffix)
+    return bool(metadata_db and _is_downloaded(metadata_db, photo, size_label, suffix))
+
+
+def _process_photo(
+    photo: Photo,
+    fname: str,
+    size_label: Optional[str],
+    skip_download: bool,
+    save_json: bool,
+) -> Downloaded:
+    """Fetch the info for a photo and save it to disk.
+
+    :param photo: photo to download
+    :param fname: file name to save the photo to (the extension is added if missing)
+    :param size_label: size to download (or None for largest available)
+    :param skip_download: do not actually download the photo
+    :param save_json: save photo info as .json file
+    :returns: whether the photo is now in place on disk, or the file it was just saved to
+    """
+    resolved = _resolve_photo(photo, fname, size_label, skip_download, save_json)
+    if resolved is None:
+        return False
+    if resolved.url is None:
+        return True
+    return _transfer_photo(photo, resolved, size_label)
+
+
+def _resolve_photo(
+    photo: Photo,
+    fname: str,
+    size_label: Optional[str],
+    skip_download: bool,
+    save_json: bool,
+) -> Optional[Resolved]:
+    """Fetch the info for a photo, save the .json file, and find out what to download.
+
+    :param photo: photo to download
+    :param fname: file name to save the photo to (the extension is added if missing)
+    :param size_label: size to download (or None for largest available)
+    :param skip_download: do not actually download the photo
+    :param save_json: save photo info as .json file
+    :returns: the resolved photo, or None if it should not be downloaded
+    """
+    api.note_photo()
+    _apply_listing_extras(photo, size_label)
     try:
         fname = photo._getOutputFilename(fname, size_label)
     except (OSError, FlickrError) as ex:
         logging.error("Error getting photo info for %s: %s", photo.id, ex)
-        return
+        return None
     json_fname = fname + ".json"
 
-    if not photo["loaded"]:
+    # The extras of the listing are enough to download the photo, the full info is only needed
+    # for the .json file
+    if not photo["loaded"] and (save_json or not photo.get("datetaken")):
         # trying not trigger two calls to Photo.getInfo here, as it will if it was already loaded
         try:
             photo.load()
         except (OSError, FlickrError) as ex:
             logging.info("Skipping %s, because cannot get info from Flickr: %s", fname, ex)
-            return
+            return None
 
     if save_json:
         try:
@@ -257,40 +1071,147 @@ def do_download_photo(
             largest_size = photo._getLargestSizeLabel()
         except (OSError, FlickrError) as ex:
             logging.error("Error getting size info for %s: %s", fname, ex)
-            return
+            return None
         if largest_size == "Video Player":
             # For old videos there doesn't seem to be an actual video url
             # available. The largest video size ends up being a SWF video player,
             # and it's the SWF that'll be downloaded...
             logging.error("Video not available for: %s", get_photo_page(photo))
-            return
+            return None
 
     if os.path.exists(fname):
-        # TODO: Ideally we should check for file size / md5 here
-        # to handle failed downloads.
+        # Transfers only rename the file into place once complete
         logging.info("Skipping %s, as it exists already", fname)
-    else:
-        logging.info("Saving: %s (%s)", fname, get_photo_page(photo))
-        if skip_download:
-            return
+        return Resolved(fname, None)
 
-        try:
-            photo.save(fname, size_label)
-        except IOError as ex:
-            logging.error("IO error saving photo: %s", ex)
-            return
-        except FlickrError as ex:
-            logging.error("Flickr error saving photo: %s", ex)
-            return
+    logging.info("Saving: %s (%s)", fname, get_photo_page(photo))
+    if skip_download:
+        return None
 
-        # Set file times to when the photo was taken
-        set_file_time(fname, photo["taken"])
+    try:
+        url = photo.getPhotoFile(size_label)
+    except (OSError, FlickrError) as ex:
+        logging.error("Error getting size info for %s: %s", fname, ex)
+        return None
+    return Resolved(fname, url)
 
-    if metadata_db:
-        metadata_db.execute(
-            "INSERT INTO downloads VALUES (?, ?, ?)", (photo.id, size_label or "", suffix)
+
+def _transfer_photo(photo: Photo, resolved: Resolved, size_label: Optional[str]) -> Downloaded:
+    """Save a resolved photo to disk.
+
+    :param photo: photo to download
+    :param resolved: the resolved photo
+    :param size_label: size to download (or None for largest available)
+    :returns: the file the photo was saved to, or whether the photo is now in place on disk
+    """
+    index = get_index()
+    source = index.find(photo.id, size_label) if index else None
+    if index and source and index.link(source, resolved.fname):
+        logging.info("Linked %s to %s", resolved.fname, source)
+        return SavedFile(resolved.fname, os.path.getsize(source))
+
+    if resolved.url is None:
+        return True
+    try:
+        saved = download_file(resolved.url, resolved.fname)
+    except IOError as ex:
+        logging.error("IO error saving photo: %s", ex)
+        return False
+
+    # Set file times to when the photo was taken
+    taken = _get_taken(photo)
+    if taken:
+        set_file_time(resolved.fname, taken)
+    if index:
+        index.add(photo.id, size_label, resolved.fname)
+    return saved
+
+
+def _get_cache_ttls(config: Any) -> Optional[Dict[str, int]]:
+    """Parse the cache_ttl setting of the configuration file.
+
+    :param config: mapping of API method to number of seconds before its responses expire
+    """
+    if config is None:
+        return None
+    try:
+        return {str(method): int(seconds) for method, seconds in dict(config).items()}
+    except (TypeError, ValueError) as ex:
+        logging.warning("Ignoring invalid cache_ttl setting: %s", ex)
+        return None
+
+
+def _log_api_summary(cache: Optional[SqliteCache], stats_file: Optional[str] = None) -> None:
+    """Log what the API calls of the run cost.
+
+    :param cache: the cache of API responses, if caching
+    :param stats_file: file to write the counters of the API calls to, as JSON
+    """
+    _log_api_stats(cache)
+    if stats_file:
+        api.get_stats().write_json(stats_file, cache.hit_ratios() if cache else None)
+    memo = api.get_memo()
+    if memo and memo.saved:
+        logging.info("Saved %d API calls by reusing the info of photos seen before", memo.saved)
+    budget = api.get_budget()
+    if budget:
+        logging.info("%s", budget.status())
+
+
+def _log_api_stats(cache: Optional[SqliteCache]) -> None:
+    """Log the counters of the API calls made so far, the throughput of the transfers, and the
+    reuse of the connections.
+
+    :param cache: the cache of API responses, if caching
+    """
+    table = api.get_stats().table(cache.hit_ratios() if cache else None)
+    logging.info("API calls:\n%s", table)
+    if transfer.get_stats():
+        logging.info("Transfers:\n%s", transfer.get_stats().table())
+    if sessions.connection_stats():
+        logging.info("Connections:\n%s", sessions.table())
+
+
+def _log_api_stats_on_signal(cache: Optional[SqliteCache]) -> None:
+    """Log the counters of the API calls made so far on SIGUSR1.
+
+    :param cache: the cache of API responses, if caching
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(sig: int, _: Any) -> None:
+        # The interrupted thread could be holding the locks needed for the counters
+        threading.Thread(target=_log_api_stats, args=(cache,), daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, handler)
+
+
+def _get_engine(
+    engine: str, workers: int, resolve_workers: Optional[int] = None, adaptive: bool = False
+) -> Engine:
+    """Creates the download engine to run parallel downloads on.
+
+    :param engine: name of the engine, "sync", "async" or "pipeline"
+    :param workers: number of worker threads, concurrent requests per host for "async", or
+        transfer workers for "pipeline"
+    :param resolve_workers: number of resolve workers for "pipeline" (defaults to workers)
+    :param adaptive: adapt the number of photos in flight to how Flickr copes
+    """
+    download_engine: Engine
+    if engine == "async":
+        download_engine = AsyncEngine(_resolve_photo, _transfer_photo, per_host=workers)
+    elif engine == "pipeline":
+        download_engine = PipelineEngine(
+            _resolve_photo, _transfer_photo, resolve_workers or workers, transfer_workers=workers
         )
-        metadata_db.commit()
+    else:
+        download_engine = ThreadEngine(_resolve_photo, _transfer_photo, workers)
+
+    if adaptive:
+        # The async engine holds many photos in flight, but only downloads workers at once
+        return AdaptiveEngine(download_engine, maximum=workers if engine == "async" else None)
+    return download_engine
 
 
 def download_photo(
@@ -335,6 +1256,13 @@ def download_user(
     skip_download: bool = False,
     save_json: bool = False,
     metadata_store: Optional[bool] = None,
+    workers: int = 1,
+    engine: str = "sync",
+    resolve_workers: Optional[int] = None,
+    prefetch_pages: Optional[int] = 0,
+    shard: Optional[Shard] = None,
+    adaptive: bool = False,
+    full_rescan: bool = False,
 ) -> None:
     """Download all the sets owned by the given user.
 
@@ -343,15 +1271,121 @@ def download_user(
     :param size_label: size to download (or None for largest available)
     :param skip_download: do not actually download the photo
     :param save_json: save photo info as .json file
+    :param workers: number of photos to download in parallel
+    :param engine: download engine to use for parallel downloads, "sync", "async" or "pipeline"
+    :param resolve_workers: number of resolve workers for the "pipeline" engine (defaults to
+        workers)
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param shard: only download the given shard of the photos
+    :param adaptive: adapt the number of photos in flight to how Flickr copes, up to what the
+        workers allow
+    :param full_rescan: list the photos of all the sets, even the ones unchanged since their
+        last download
     """
     user = find_user(username)
     photosets: Walker[Photoset] = Walker(user.getPhotosets)  # pylint: disable=E1101
+    if workers > 1 or engine != "sync":
+        _download_sets_parallel(
+            photosets,
+            get_filename,
+            size_label,
+            skip_download,
+            save_json,
+            metadata_store,
+            workers,
+            engine,
+            resolve_workers,
+            prefetch_pages,
+            shard,
+            adaptive,
+            not full_rescan,
+        )
+        return
+
     for photoset in photosets:
-        download_set(
-            photoset.id, get_filename, size_label, skip_download, save_json, metadata_store
+        download_list(
+            photoset,
+            photoset.title,
+            get_filename,
+            size_label,
+            skip_download,
+            save_json,
+            metadata_store,
+            workers,
+            engine,
+            resolve_workers,
+            prefetch_pages,
+            shard,
+            adaptive,
+            skip_unchanged=not full_rescan,
         )
 
 
+def _download_sets_parallel(
+    photosets: Iterable[Photoset],
+    get_filename: FilenameHandler,
+    size_label: Optional[str],
+    skip_download: bool,
+    save_json: bool,
+    metadata_store: Optional[bool],
+    workers: int,
+    engine: str,
+    resolve_workers: Optional[int],
+    prefetch_pages: Optional[int],
+    shard: Optional[Shard],
+    adaptive: bool,
+    skip_unchanged: bool,
+) -> None:
+    """Download several photo sets at the same time.
+
+    All the sets share one download engine, and so one concurrency budget. Each set being
+    downloaded gets an equal share of the photos in flight.
+
+    :param photosets: the photo sets to download
+    :param workers: number of photos to download in parallel
+    :param engine: download engine to use, "sync", "async" or "pipeline"
+    :param resolve_workers: number of resolve workers for the "pipeline" engine
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param shard: only download the given shard of the photos
+    :param adaptive: adapt the number of photos in flight to how Flickr copes, up to what the
+        workers allow
+    :param skip_unchanged: skip the sets unchanged since their last complete download
+    """
+    shared_engine = SharedEngine(_get_engine(engine, workers, resolve_workers, adaptive))
+
+    def download(photoset: Photoset) -> None:
+        with shared_engine.attach():
+            download_list(
+                photoset,
+                photoset.title,
+                get_filename,
+                size_label,
+                skip_download,
+                save_json,
+                metadata_store,
+                workers,
+                shared_engine,
+                prefetch_pages=prefetch_pages,
+                shard=shard,
+                skip_unchanged=skip_unchanged,
+            )
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photoset")
+    try:
+        for future in [executor.submit(download, photoset) for photoset in photosets]:
+            future.result()
+    except BaseException:
+        # Stop the sets being downloaded before the engine goes, and give up on the others
+        shared_engine.stop()
+        executor.shutdown(wait=False, cancel_futures=True)
+        shared_engine.engine.shutdown(cancel=True)
+        raise
+    executor.shutdown()
+    shared_engine.engine.shutdown()
+
+
 def download_user_photos(
     username: str,
     get_filename: FilenameHandler,
@@ -359,21 +1393,178 @@ def download_user_photos(
     skip_download: bool = False,
     save_json: bool = False,
     metadata_store: Optional[bool] = None,
+    workers: int = 1,
+    engine: str = "sync",
+    resolve_workers: Optional[int] = None,
+    prefetch_pages: Optional[int] = 0,
+    shard: Optional[Shard] = None,
+    adaptive: bool = False,
+    full_rescan: bool = False,
 ) -> None:
     """Download all the photos owned by the given user.
 
+    With a metadata store, only the photos uploaded since the last complete download are listed,
+    unless doing a full rescan.
+
     :param username: username
     :param get_filename: function that creates a filename for the photo
     :param size_label: size to download (or None for largest available)
     :param skip_download: do not actually download the photo
     :param save_json: save photo info as .json file
+    :param workers: number of photos to download in parallel
+    :param engine: download engine to use for parallel downloads, "sync", "async" or "pipeline"
+    :param resolve_workers: number of resolve workers for the "pipeline" engine (defaults to
+        workers)
+    :param prefetch_pages: number of listing pages to fetch ahead in the background, or None to
+        fetch all of them at once
+    :param shard: only download the given shard of the photos
+    :param adaptive: adapt the number of photos in flight to how Flickr copes, up to what the
+        workers allow
+    :param full_rescan: list all the photos of the user, even if downloaded before
     """
     user = find_user(username)
     download_list(
-        user, username, get_filename, size_label, skip_download, save_json, metadata_store
+        user,
+        username,
+        get_filename,
+        size_label,
+        skip_download,
+        save_json,
+        metadata_store,
+        workers,
+        engine,
+        resolve_workers,
+        prefetch_pages,
+        shard,
+        adaptive,
+        incremental=not full_rescan,
     )
 
 
+def verify_downloads(root: str = ".", workers: Optional[int] = None) -> int:
+    """Check the files downloaded to the directories under root against their metadata stores.
+
+    The files are checked for the size and checksum recorded when downloading them, or for
+    starting like a file of their type should if they have no checksum. Bad files are renamed
+    with a .bad suffix and forgotten by the metadata stores, so that the next download of their
+    set or user downloads them again. The metadata stores of the shards of a sharded download
+    count too, merged or not.
+
+    :param root: the directory the sets were downloaded to
+    :param workers: number of processes checking files (defaults to the number of CPUs)
+    :returns: number of bad files
+    """
+    # By path, as a file may be recorded both by a shard and by the merged metadata store
+    records: Dict[str, Tuple[Path, DownloadKey, FileCheck]] = {}
+    dirnames = {path.parent for path in Path(root).glob(os.path.join("*", ".metadata*.db"))}
+    for dirname in sorted(dirnames):
+        for shard in _get_metadata_db_shards(str(dirname)):
+            conn = _get_metadata_db(str(dirname), shard)
+            for photo_id, size_label, suffix, path, size, sha256 in conn.execute(
+                "SELECT photo_id, size_label, suffix, path, size, sha256 FROM files"
+            ):
+                check = FileCheck(str(dirname / path), size, sha256)
+                records.setdefault(check.path, (dirname, (photo_id, size_label, suffix), check))
+            conn.close()
+
+    logging.info("Verifying %d files", len(records))
+    bad = check_files((check for _, _, check in records.values()), workers)
+    problems = {check.path: problem for check, problem in bad}
+    bad_records = [record for record in records.values() if record[2].path in problems]
+    for dirname, group in itertools.groupby(bad_records, key=lambda record: record[0]):
+        keys = []
+        for _, key, check in group:
+            logging.warning(
+                "%s is bad (%s), it will be downloaded again", check.path, problems[check.path]
+            )
+            keys.append(key)
+            try:
+                os.replace(check.path, check.path + BAD_SUFFIX)
+            except FileNotFoundError:
+                pass
+        for shard in _get_metadata_db_shards(str(dirname)):
+            conn = _get_metadata_db(str(dirname), shard)
+            for table in ["downloads", "files"]:
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE photo_id = ? AND size_label = ? AND suffix = ?",
+                    keys,
+                )
+            # Otherwise the set would be skipped as unchanged, or the photos not listed again
+            conn.execute("DELETE FROM sync_state")
+            conn.execute("DELETE FROM album_state")
+            conn.close()
+
+    logging.info("%d of %d files are bad", len(bad), len(records))
+    return len(bad)
+
+
+def merge_shards(
+    pset: Union[Photoset, Person],
+    photos_title: str,
+    shards: int,
+    size_label: Optional[str],
+) -> int:
+    """Merge the metadata stores of the shards of a sharded download, and check that the shards
+    together downloaded all the photos in the photo list.
+
+    The records of all the shards, with the files they were saved to, are merged into the
+    regular metadata store of the photo list.
+
+    :param pset: photo list that was downloaded
+    :param photos_title: name of the photo list
+    :param shards: number of shards the download was split in
+    :param size_label: size that was downloaded (or None for largest available)
+    :returns: number of photos missing
+    """
+    suffix = f" ({size_label})" if size_label else ""
+    dirname = get_dirname(photos_title)
+    if not os.path.exists(dirname):
+        # download_list truncates names that are too long
+        dirname = dirname[:200]
+    if not os.path.exists(dirname):
+        logging.error("Nothing downloaded for %s", photos_title)
+        return len(Walker(pset.getPhotos))
+
+    conn = _get_metadata_db(dirname)
+    for index in range(1, shards + 1):
+        shard_path = Path(dirname) / _get_metadata_db_name((index, shards))
+        if not shard_path.exists():
+            logging.warning("No metadata store found for shard %d/%d", index, shards)
+            continue
+        conn.execute("ATTACH DATABASE ? AS shard", (str(shard_path),))
+        conn.execute(
+            "INSERT OR IGNORE INTO downloads SELECT photo_id, size_label, suffix"
+            " FROM shard.downloads"
+        )
+        if conn.execute(
+            "SELECT 1 FROM shard.sqlite_master WHERE type = 'table' AND name = 'files'"
+        ).fetchone():
+            conn.execute("INSERT OR REPLACE INTO files SELECT * FROM shard.files")
+        conn.commit()
+        conn.execute("DETACH DATABASE shard")
+
+    photos: Walker[Photo] = Walker(pset.getPhotos)
+    missing = [photo.id for photo in photos if not _is_downloaded(conn, photo, size_label, suffix)]
+    conn.close()
+
+    if missing:
+        logging.error("%s is missing %d photos: %s", photos_title, len(missing), ", ".join(missing))
+    else:
+        logging.info("%s is complete", photos_title)
+    return len(missing)
+
+
+def _parse_shard(value: str) -> Shard:
+    """Parses a K/N shard argument."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value} (expected K/N)")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value} (K must be between 1 and N)")
+    return index, count
+
+
 def print_sets(username: str) -> None:
     """Print all sets for the given user.
 
@@ -481,6 +1672,85 @@ def _get_arg_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Store information about downloads in a metadata file (helps with retrying downloads)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        default=1,
+        help="Download N photos in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["sync", "async", "pipeline"],
+        default="sync",
+        help="Engine for parallel downloads: a pool of threads (sync), an asyncio event loop\n"
+        "with at most N concurrent requests per host, N being --workers (async), or a pipeline\n"
+        "of resolve and transfer workers (pipeline)",
+    )
+    parser.add_argument(
+        "--resolve_workers",
+        type=int,
+        metavar="M",
+        help="Number of workers resolving photo info with --engine pipeline (default: N)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt the number of downloads in flight to how Flickr copes (throttling, errors\n"
+        "and latency), up to what --workers allows",
+    )
+    parser.add_argument(
+        "--prefetch_pages",
+        type=int,
+        metavar="PAGES",
+        default=0,
+        help="Fetch PAGES pages of photo listings ahead in the background (default: 0)",
+    )
+    parser.add_argument(
+        "--prefetch_all_pages",
+        action="store_true",
+        help="Fetch all the pages of photo listings at once (for very large listings)",
+    )
+    parser.add_argument(
+        "--full_rescan",
+        action="store_true",
+        help="List all the photos again with --download_user and --download_user_photos, instead\n"
+        "of only the changed sets and the photos uploaded since the last complete download\n"
+        "(with --metadata_store)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the files downloaded with --metadata_store for their size, checksum and file\n"
+        "type, in parallel. Bad files are renamed to .bad, to be downloaded again.",
+    )
+    parser.add_argument(
+        "--dedupe",
+        choices=LINK_MODES,
+        help="Link photos downloaded before (for example in another set) instead of downloading\n"
+        f"them again, keeping track of them in {INDEX_FILE}",
+    )
+    parser.add_argument(
+        "--api_stats",
+        type=str,
+        metavar="STATS_FILE",
+        help="Write the number of calls, cache hits, retries, errors and the latency of every API\n"
+        "method to STATS_FILE as JSON at the end of the run",
+    )
+    parser.add_argument(
+        "--shard",
+        type=_parse_shard,
+        metavar="K/N",
+        help="Only download the Kth of N shards of the photos, to split a download across\n"
+        "processes or machines (implies --metadata_store)",
+    )
+    parser.add_argument(
+        "--merge_shards",
+        type=int,
+        metavar="N",
+        help="Merge the metadata stores of a download done in N shards, and check that no\n"
+        "photos are missing",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Turns on verbose logging")
     parser.add_argument(
         "--version",
@@ -506,12 +1776,24 @@ def main() -> int:
 
     cache = None
     if args.cache:
-        cache = init_cache(args.cache)
+        cache = init_cache(
+            args.cache,
+            _get_cache_ttls(getattr(args, "cache_ttl", None)),
+            int(getattr(args, "cache_max_mb", DEFAULT_MAX_BYTES // MB)) * MB,
+        )
 
     if args.list_naming:
         print(get_filename_handler_help())
         return 1
 
+    download = args.download or args.download_user or args.download_user_photos
+    if args.verify:
+        bad = verify_downloads(".")
+        if not download:
+            if cache:
+                cache.close()
+            return 1 if bad else 0
+
     if not args.api_key or not args.api_secret:
         print(
             'You need to pass in both "api_key" and "api_secret" arguments',
@@ -522,11 +1804,19 @@ def main() -> int:
     ret = _init(args.api_key, args.api_secret, args.user_auth)
     if not ret:
         return 1
+    api.set_budget(getattr(args, "api_budget", api.DEFAULT_CALLS_PER_HOUR))
+    transfer.set_options(
+        int(getattr(args, "chunk_kb", transfer.CHUNK_SIZE // 1024)) * 1024,
+        bool(getattr(args, "preallocate", False)),
+    )
+    # Keep a connection alive for every worker
+    sessions.set_pool_size(max(sessions.DEFAULT_POOL_SIZE, args.workers, args.resolve_workers or 0))
+    _log_api_stats_on_signal(cache)
 
     if args.list:
         print_sets(args.list)
         if cache:
-            save_cache(args.cache, cache)
+            cache.close()
         return 0
 
     if args.skip_download:
@@ -535,6 +1825,35 @@ def main() -> int:
     if args.save_json:
         logging.info("Will save photo info in .json file with same basename as photo")
 
+    if args.shard:
+        logging.info("Will download shard %d of %d", *args.shard)
+        args.metadata_store = True
+
+    if args.merge_shards:
+        photo_lists: List[Tuple[Union[Photoset, Person], str]] = []
+        if args.download:
+            pset = Flickr.Photoset(id=args.download)
+            photo_lists.append((pset, pset.title))
+        elif args.download_user:
+            user = find_user(args.download_user)
+            photosets: Walker[Photoset] = Walker(user.getPhotosets)  # pylint: disable=E1101
+            photo_lists.extend((photoset, photoset.title) for photoset in photosets)
+        elif args.download_user_photos:
+            photo_lists.append((find_user(args.download_user_photos), args.download_user_photos))
+        else:
+            print("ERROR: --merge_shards needs a set or user to merge\n", file=sys.stderr)
+            return 1
+        missing = sum(
+            merge_shards(pset, title, args.merge_shards, args.quality)
+            for pset, title in photo_lists
+        )
+        if cache:
+            cache.close()
+        return 1 if missing else 0
+
+    if args.dedupe:
+        set_index(PhotoIndex(INDEX_FILE, args.dedupe))
+
     if args.download or args.download_user or args.download_user_photos or args.download_photo:
         try:
             get_filename = get_filename_handler(args.naming)
@@ -546,6 +1865,12 @@ def main() -> int:
                     args.skip_download,
                     args.save_json,
                     args.metadata_store,
+                    args.workers,
+                    args.engine,
+                    args.resolve_workers,
+                    None if args.prefetch_all_pages else args.prefetch_pages,
+                    args.shard,
+                    args.adaptive,
                 )
             elif args.download_user:
                 download_user(
@@ -555,6 +1880,13 @@ def main() -> int:
                     args.skip_download,
                     args.save_json,
                     args.metadata_store,
+                    args.workers,
+                    args.engine,
+                    args.resolve_workers,
+                    None if args.prefetch_all_pages else args.prefetch_pages,
+                    args.shard,
+                    args.adaptive,
+                    args.full_rescan,
                 )
             elif args.download_photo:
                 download_photo(
@@ -572,19 +1904,31 @@ def main() -> int:
                     args.skip_download,
                     args.save_json,
                     args.metadata_store,
+                    args.workers,
+                    args.engine,
+                    args.resolve_workers,
+                    None if args.prefetch_all_pages else args.prefetch_pages,
+                    args.shard,
+                    args.adaptive,
+                    args.full_rescan,
                 )
         except KeyboardInterrupt:
             print(
-                "Forcefully aborting. Last photo download might be partial :(",
+                "Forcefully aborting. Partial downloads are resumed on the next run.",
                 file=sys.stderr,
             )
         except Exception:
             if cache:
-                save_cache(args.cache, cache)
+                cache.close()
             raise
 
+        _log_api_summary(cache, args.api_stats)
+        index = get_index()
+        if index:
+            logging.info("Linked %d photos downloaded before", index.linked)
+            index.close()
         if cache:
-            save_cache(args.cache, cache)
+            cache.close()
         return 0
 
     print("ERROR: Nothing to do?\n", file=sys.stderr)
@@ -0,0 +1,74 @@
+"""HTTP session shared by the API requests and the photo transfers.
+
+`requests.post` and `requests.get` open a new connection (and TLS handshake) for every request.
+The shared session keeps the connections alive instead, in a pool per host: one for the API host,
+and one for each host serving photo files.
+"""
+
+import threading
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of hosts to keep a pool of connections for
+POOL_HOSTS = 32
+
+# Default number of connections kept alive per host, as for requests
+DEFAULT_POOL_SIZE = 10
+
+_SESSION: Optional[requests.Session] = None
+_POOL_SIZE = DEFAULT_POOL_SIZE
+_LOCK = threading.Lock()
+
+
+def set_pool_size(size: int) -> None:
+    """Set the number of connections kept alive per host, for example to the number of workers.
+
+    Connections beyond that are still opened when needed, but closed after their request.
+    """
+    global _POOL_SIZE, _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        _POOL_SIZE = size
+        if _SESSION:
+            _SESSION.close()
+        _SESSION = None
+
+
+def get_session() -> requests.Session:
+    """The shared session, created on first use."""
+    global _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=_POOL_SIZE)
+            _SESSION.mount("https://", adapter)
+            _SESSION.mount("http://", adapter)
+            # The API responses are JSON, and compress well
+            _SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+        return _SESSION
+
+
+def connection_stats() -> List[Tuple[str, int, int]]:
+    """Returns the number of connections opened and of requests made, by host."""
+    with _LOCK:
+        if _SESSION is None:
+            return []
+        stats = []
+        for adapter in set(_SESSION.adapters.values()):
+            if not isinstance(adapter, HTTPAdapter):
+                continue
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats.append((str(pool.host), pool.num_connections, pool.num_requests))
+        return sorted(stats)
+
+
+def table() -> str:
+    """Returns the connection reuse as a table, one host per line."""
+    lines = [f"{'Host':<32} {'connections':>11} {'requests':>8} {'reuse':>6}"]
+    for host, connections, requests_made in connection_stats():
+        reuse = requests_made / connections if connections else 0.0
+        lines.append(f"{host:<32} {connections:>11} {requests_made:>8} {reuse:>6.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+"""Counters of the API calls made during a run, by API method."""
+
+import json
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Upper bounds in seconds of the buckets of the latency histogram, the last bucket is unbounded
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Number of hits and lookups of the cache, by API method
+CacheHits = List[Tuple[str, int, int]]
+
+
+class MethodStats:
+    """Counters of the calls of one API method."""
+
+    def __init__(self) -> None:
+        # Calls made through flickr_api, however they were answered
+        self.calls = 0
+        # Calls failing with an error
+        self.errors = 0
+        # Calls answered from the memo of the run
+        self.memo_hits = 0
+        # Calls that had to go to Flickr
+        self.fetches = 0
+        # HTTP requests made, including the retries
+        self.requests = 0
+        # HTTP requests failing (HTTP errors or no response at all)
+        self.failed_requests = 0
+        self.seconds = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.requests - self.fetches)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Upper bound of the latency bucket the given fraction of the requests falls in (inf for
+        the last bucket), or None without requests.
+        """
+        if not self.requests:
+            return None
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency):
+            seen += count
+            if seen >= fraction * self.requests:
+                return bound
+        return float("inf")
+
+
+class ApiStats:
+    """Counts the calls of every API method, how they were answered, and the latency of the
+    HTTP requests.
+    """
+
+    def __init__(self) -> None:
+        self._methods: Dict[str, MethodStats] = defaultdict(MethodStats)
+        self._lock = threading.Lock()
+
+    def count_call(self, method: str, error: bool) -> None:
+        with self._lock:
+            self._methods[method].calls += 1
+            if error:
+                self._methods[method].errors += 1
+
+    def count_memo_hit(self, method: str) -> None:
+        with self._lock:
+            self._methods[method].memo_hits += 1
+
+    def count_fetch(self, method: str) -> None:
+        with self._lock:
+            self._methods[method].fetches += 1
+
+    def count_request(self, method: str, status: Optional[int], seconds: float) -> None:
+        """Count an HTTP request, see api.RequestObserver."""
+        bucket = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS) if seconds < bound), len(LATENCY_BUCKETS)
+        )
+        with self._lock:
+            stats = self._methods[method]
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.latency[bucket] += 1
+            if status is None or status >= 400:
+                stats.failed_requests += 1
+
+    def snapshot(self, cache_hits: Optional[CacheHits] = None) -> Dict[str, Dict[str, Any]]:
+        """Returns the counters by API method.
+
+        :param cache_hits: hits and lookups of the cache by API method, if caching
+        """
+        cache = {method: (hits, lookups) for method, hits, lookups in cache_hits or []}
+        with self._lock:
+            methods = sorted(set(self._methods) | set(cache))
+            result = {}
+            for method in methods:
+                stats = self._methods[method]
+                hits, lookups = cache.get(method, (0, 0))
+                result[method] = {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "memo_hits": stats.memo_hits,
+                    "cache_hits": hits,
+                    "cache_misses": lookups - hits,
+                    "requests": stats.requests,
+                    "failed_requests": stats.failed_requests,
+                    "retries": stats.retries,
+                    "seconds": round(stats.seconds, 3),
+                    "latency": {
+                        f"<{bound}s": count for bound, count in zip(LATENCY_BUCKETS, stats.latency)
+                    }
+                    | {f">={LATENCY_BUCKETS[-1]}s": stats.latency[-1]},
+                    "p50": stats.percentile(0.5),
+                    "p90": stats.percentile(0.9),
+                }
+            return result
+
+    def table(self, cache_hits: Optional[CacheHits] = None) -> str:
+        """Returns the counters as a table, one API method per line.
+
+        :param cache_hits: hits and lookups of the cache by API method, if caching
+        """
+
+        def latency(bound: Optional[float]) -> str:
+            if bound is None:
+                return "-"
+            if bound == float("inf"):
+                return f">={LATENCY_BUCKETS[-1]}s"
+            return f"<{bound}s"
+
+        lines = [
+            f"{'API method':<32} {'calls':>7} {'memo':>6} {'cache hit/miss':>15} "
+            f"{'requests':>8} {'retries':>7} {'errors':>6} {'p50':>7} {'p90':>7}"
+        ]
+        for method, stats in self.snapshot(cache_hits).items():
+            cache = f"{stats['cache_hits']}/{stats['cache_misses']}"
+            lines.append(
+                f"{method:<32} {stats['calls']:>7} {stats['memo_hits']:>6} {cache:>15} "
+                f"{stats['requests']:>8} {stats['retries']:>7} {stats['errors']:>6} "
+                f"{latency(stats['p50']):>7} {latency(stats['p90']):>7}"
+            )
+        return "\n".join(lines)
+
+    def write_json(self, path: str, cache_hits: Optional[CacheHits] = None) -> None:
+        """Write the counters by API method to a JSON file.
+
+        :param path: the file to write
+        :param cache_hits: hits and lookups of the cache by API method, if caching
+        """
+        snapshot = self.snapshot(cache_hits)
+        for stats in snapshot.values():
+            # JSON has no infinity
+            for key in ["p50", "p90"]:
+                if stats[key] == float("inf"):
+                    stats[key] = None
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(snapshot, handle, indent=2, sort_keys=True)
@@ -0,0 +1,313 @@
+"""Transfers of the photo files themselves.
+
+A photo is written to a .part file next to its final name, and only renamed into place once it
+has the size the server announced. That way a file under its final name is always complete, and
+an interrupted transfer is resumed from where it stopped. The URL and the validator (ETag or
+Last-Modified) of the file being downloaded are kept next to the .part file, so a partial file is
+only resumed from the same file, and unchanged since.
+
+Responses are streamed to disk a chunk at a time, so the memory used does not depend on the size
+of the photo or video. The throughput of the transfers is kept by host, to spot slow servers.
+Like the API requests, every transfer request can be observed, for example to adapt the
+concurrency of the downloads.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from flickr_download.sessions import get_session
+
+# Suffix of the files being downloaded
+PART_SUFFIX = ".part"
+
+# Suffix of the file next to a .part file telling where it comes from
+PART_INFO_SUFFIX = ".json"
+
+MB = 1024 * 1024
+
+# Default number of bytes read from the response and written at a time
+CHUNK_SIZE = MB
+
+# Default number of seconds to wait for the server
+DEFAULT_TIMEOUT = 60.0
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+# Called with the host, the HTTP status (None if the request failed altogether) and the number
+# of seconds until the response arrived, not counting the transfer of the file itself
+TransferObserver = Callable[[str, Optional[int], float], None]
+
+_OBSERVERS: List[TransferObserver] = []
+_OBSERVERS_LOCK = threading.Lock()
+
+_chunk_size = CHUNK_SIZE
+_preallocate = False
+
+
+def set_options(chunk_size: int = CHUNK_SIZE, preallocate: bool = False) -> None:
+    """Set how files are written.
+
+    :param chunk_size: number of bytes read from the response and written at a time
+    :param preallocate: reserve the disk space of a file before writing it (where supported).
+        Partial downloads are then restarted instead of resumed, as the partial file has the
+        full size from the start. A partial file left preallocated by a crash is restarted
+        even without this option.
+    """
+    global _chunk_size, _preallocate  # pylint: disable=global-statement
+    _chunk_size = chunk_size
+    _preallocate = preallocate
+
+
+class TransferStats:
+    """Counts the bytes transferred and the time spent, by host."""
+
+    def __init__(self) -> None:
+        # Number of files, bytes and seconds by host
+        self._hosts: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0])
+        self._lock = threading.Lock()
+
+    def count(self, host: str, size: int, seconds: float) -> None:
+        with self._lock:
+            stats = self._hosts[host]
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += seconds
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._hosts)
+
+    def table(self) -> str:
+        """Returns the throughput as a table, one host per line, slowest first."""
+        with self._lock:
+            hosts = sorted(self._hosts.items(), key=lambda item: item[1][1] / max(item[1][2], 1e-6))
+        lines = [f"{'Host':<32} {'files':>7} {'MB':>10} {'MB/s':>8}"]
+        for host, (files, size, seconds) in hosts:
+            lines.append(
+                f"{host:<32} {int(files):>7} {size / MB:>10.1f} {_rate(size, seconds):>8.2f}"
+            )
+        return "\n".join(lines)
+
+
+_STATS = TransferStats()
+
+
+def get_stats() -> TransferStats:
+    """The throughput of the transfers of the run."""
+    return _STATS
+
+
+def add_transfer_observer(observer: TransferObserver) -> None:
+    """Register a function to be called after every transfer request."""
+    with _OBSERVERS_LOCK:
+        _OBSERVERS.append(observer)
+
+
+def remove_transfer_observer(observer: TransferObserver) -> None:
+    """Unregister a function registered with add_transfer_observer."""
+    with _OBSERVERS_LOCK:
+        _OBSERVERS.remove(observer)
+
+
+def _notify(host: str, status: Optional[int], seconds: float) -> None:
+    with _OBSERVERS_LOCK:
+        observers = list(_OBSERVERS)
+    for observer in observers:
+        observer(host, status, seconds)
+
+
+class IncompleteDownload(IOError):
+    """The transfer ended before the whole file arrived."""
+
+
+class SavedFile(NamedTuple):
+    """A file a photo was saved to."""
+
+    path: str
+    size: int
+    # SHA-256 of the content, if known
+    sha256: Optional[str] = None
+
+
+def hash_file(path: str, block_size: int = CHUNK_SIZE) -> Tuple[int, str]:
+    """Returns the size and the SHA-256 of a file, reading it in large blocks."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as handle:
+        for block in read_blocks(handle, block_size):
+            digest.update(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+
+def read_blocks(handle: BinaryIO, block_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Read a file block by block."""
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def download_file(url: str, fname: str, timeout: float = DEFAULT_TIMEOUT) -> SavedFile:
+    """Download a file, resuming an earlier partial download of it.
+
+    :param url: the URL of the file
+    :param fname: the file name to save it to
+    :param timeout: number of seconds to wait for the server
+    :returns: the saved file, with its checksum computed along the way
+    :raises IncompleteDownload: if fewer bytes arrived than announced, the partial file is kept
+        to be resumed
+    """
+    part = fname + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    info = _read_part_info(part) if offset else {}
+    if offset and (_preallocate or info.get("url") != url or info.get("preallocated")):
+        # Only resume a partial file known to come from the same URL, and not left preallocated
+        # (by a crash) with space never written to
+        logging.info("Restarting the download of %s", fname)
+        os.remove(part)
+        offset = 0
+    # The sizes are only comparable for the bytes as sent
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if info.get("validator"):
+            # The server sends the whole file again if it changed since
+            headers["If-Range"] = info["validator"]
+
+    host = urlparse(url).netloc
+    started = time.monotonic()
+    try:
+        resp = get_session().get(url, headers=headers, stream=True, timeout=timeout)
+    except requests.RequestException:
+        _notify(host, None, time.monotonic() - started)
+        raise
+    _notify(host, resp.status_code, time.monotonic() - started)
+    with resp:
+        if offset and resp.status_code == 416:
+            # The partial file may be complete already, or not match the file at all anymore
+            total = _get_total_size(resp.headers.get("Content-Range"))
+            if total == offset:
+                _, sha256 = hash_file(part)
+                os.replace(part, fname)
+                _remove_part_info(part)
+                return SavedFile(fname, offset, sha256)
+            logging.info("Restarting the download of %s", fname)
+            os.remove(part)
+            _remove_part_info(part)
+            return download_file(url, fname, timeout)
+        resp.raise_for_status()
+
+        digest = hashlib.sha256()
+        if offset and resp.status_code == 206:
+            start = _get_range_start(resp.headers.get("Content-Range"))
+            if start != offset:
+                raise IncompleteDownload(f"Unexpected range for {fname}: {start} from {offset}")
+            logging.info("Resuming the download of %s from %d bytes", fname, offset)
+            expected = _get_total_size(resp.headers.get("Content-Range"))
+            mode = "ab"
+            with open(part, "rb") as handle:
+                for block in read_blocks(handle):
+                    digest.update(block)
+        else:
+            # No partial file, or the server sends the whole file again
+            offset = 0
+            length = resp.headers.get("Content-Length")
+            expected = int(length) if length is not None else None
+            mode = "wb"
+
+        preallocate = _preallocate and mode == "wb" and hasattr(os, "posix_fallocate")
+        if mode == "wb":
+            _write_part_info(part, url, resp.headers, preallocated=bool(preallocate and expected))
+        with open(part, mode) as handle:
+            if preallocate and expected:
+                try:
+                    os.posix_fallocate(handle.fileno(), 0, expected)
+                except OSError as ex:
+                    logging.debug("Could not preallocate %s: %s", part, ex)
+            try:
+                for chunk in resp.iter_content(_chunk_size):
+                    handle.write(chunk)
+                    digest.update(chunk)
+            finally:
+                # Drop the preallocated space not written to
+                handle.truncate()
+                if preallocate and expected:
+                    _write_part_info(part, url, resp.headers)
+
+    seconds = time.monotonic() - started
+    size = os.path.getsize(part)
+    _STATS.count(host, size - offset, seconds)
+    logging.info(
+        "Transferred %s: %.1f MB in %.1fs (%.2f MB/s from %s)",
+        fname,
+        (size - offset) / MB,
+        seconds,
+        _rate(size - offset, seconds),
+        host,
+    )
+    if expected is not None and size != expected:
+        raise IncompleteDownload(f"Only got {size} of {expected} bytes of {fname}")
+    os.replace(part, fname)
+    _remove_part_info(part)
+    return SavedFile(fname, size, digest.hexdigest())
+
+
+def _read_part_info(part: str) -> Dict[str, Any]:
+    """Where a partial file comes from, empty if not known."""
+    try:
+        with open(part + PART_INFO_SUFFIX, encoding="utf-8") as handle:
+            info = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return info if isinstance(info, dict) else {}
+
+
+def _write_part_info(part: str, url: str, headers: Any, preallocated: bool = False) -> None:
+    """Keep the URL of a partial file, and what tells whether the file changed on the server.
+    Weak ETags can't be used to resume a download. A partial file marked as preallocated may
+    hold space never written to, until it is truncated.
+    """
+    validator = headers.get("ETag")
+    if not validator or validator.startswith("W/"):
+        validator = headers.get("Last-Modified")
+    with open(part + PART_INFO_SUFFIX, "w", encoding="utf-8") as handle:
+        json.dump({"url": url, "validator": validator, "preallocated": preallocated}, handle)
+
+
+def _remove_part_info(part: str) -> None:
+    try:
+        os.remove(part + PART_INFO_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def _rate(size: float, seconds: float) -> float:
+    """MB per second."""
+    return size / MB / seconds if seconds > 0 else 0.0
+
+
+def _get_range_start(content_range: Optional[str]) -> Optional[int]:
+    match = _CONTENT_RANGE.match(content_range or "")
+    return int(match.group(1)) if match else None
+
+
+def _get_total_size(content_range: Optional[str]) -> Optional[int]:
+    """The total size of the file from a Content-Range header (bytes a-b/total or
+    bytes */total).
+    """
+    if not content_range or "/" not in content_range:
+        return None
+    total = content_range.rsplit("/", 1)[1]
+    return int(total) if total.isdigit() else None
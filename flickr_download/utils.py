@@ -4,60 +4,31 @@ from __future__ import annotations
 
 import logging
 import os
-import pickle
-import signal
-import sys
 import time
-from pathlib import Path
-from types import FrameType
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 import flickr_api as Flickr
 from dateutil import parser
-from flickr_api.cache import SimpleCache
 from flickr_api.objects import Person, Photo, Tag
 from pathvalidate import sanitize_filename, sanitize_filepath
 
+from flickr_download.cache import DEFAULT_MAX_BYTES, SqliteCache, open_cache
 
-def get_cache(path: str) -> SimpleCache:
-    """Loads the cache from disk, or returns an empty one if not found."""
-    cache = SimpleCache(max_entries=20000, timeout=3600)
-    cache_path = Path(path)
-    if not cache_path.exists():
-        return cache
 
-    with cache_path.open("rb") as handle:
-        database = pickle.load(handle)
-        cache.storage = database["storage"]
-        logging.debug("Cache loaded from: %s", cache_path.resolve())
-        cache.expire_info = database["expire_info"]
-        return cache
+def init_cache(
+    path: str, ttls: Optional[Dict[str, int]] = None, max_bytes: int = DEFAULT_MAX_BYTES
+) -> SqliteCache:
+    """Open the cache (importing a pickled one) and enable it for all API calls.
 
+    Entries are written as they are added, so nothing needs saving at exit.
 
-def save_cache(path: str, cache: SimpleCache) -> bool:
-    """Saves the cache to disk."""
-    database = {"storage": cache.storage, "expire_info": cache.expire_info}
-    cache_path = Path(path)
-    with cache_path.open("wb") as handle:
-        pickle.dump(database, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    logging.debug("Cache saved to %s", cache_path.resolve())
-    return True
-
-
-def init_cache(path: str) -> SimpleCache:
-    """Initialize the cache and install a signal handler to automatically save
-    it."""
-    cache = get_cache(path)
+    :param path: the cache file
+    :param ttls: number of seconds before the cached responses expire, by API method
+    :param max_bytes: maximum size of the compressed responses
+    """
+    cache = open_cache(path, ttls, max_bytes)
     Flickr.enable_cache(cache)
 
-    def signal_handler(sig: int, _: Optional[FrameType]) -> Any:
-        logging.debug("Hit signal handler for signal %s", sig)
-        save_cache(path, cache)
-        sys.exit(sig)
-
-    signal.signal(signal.SIGINT, signal_handler)
-
     logging.info("Caching is enabled")
 
     return cache
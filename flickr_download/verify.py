@@ -0,0 +1,85 @@
+"""Checks of the downloaded files against what was recorded when downloading them."""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from flickr_download.transfer import read_blocks
+
+# Size of the blocks files are read in, large enough to read at disk speed
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# Suffix bad files are renamed with, to be looked at or removed by hand
+BAD_SUFFIX = ".bad"
+
+# How the files of the types Flickr serves start: (offset, bytes), by file extension
+MAGIC_BYTES = {
+    ".jpg": (0, b"\xff\xd8\xff"),
+    ".jpeg": (0, b"\xff\xd8\xff"),
+    ".png": (0, b"\x89PNG\r\n\x1a\n"),
+    ".gif": (0, b"GIF8"),
+    ".mp4": (4, b"ftyp"),
+    ".mov": (4, b"ftyp"),
+}
+
+
+class FileCheck(NamedTuple):
+    """A file to check, as recorded when downloading it."""
+
+    path: str
+    # Size and SHA-256 of the file, if recorded
+    size: Optional[int]
+    sha256: Optional[str]
+
+
+def check_file(check: FileCheck) -> Optional[str]:
+    """Check a file for its size, its checksum and whether it starts like its type should.
+
+    A file matching its checksum is the file as downloaded, so only files without one are
+    checked for their type.
+
+    :param check: the file to check
+    :returns: what is wrong with the file, or None if nothing
+    """
+    try:
+        size = os.path.getsize(check.path)
+    except OSError:
+        return "missing"
+    if check.size is not None and size != check.size:
+        return f"{size} bytes instead of {check.size}"
+
+    digest = hashlib.sha256()
+    header = b""
+    with open(check.path, "rb") as handle:
+        for block in read_blocks(handle, BLOCK_SIZE):
+            if not header:
+                header = block[:64]
+            if check.sha256:
+                digest.update(block)
+            else:
+                break
+
+    if check.sha256:
+        return "checksum mismatch" if digest.hexdigest() != check.sha256 else None
+    magic = MAGIC_BYTES.get(os.path.splitext(check.path)[1].lower())
+    if magic and header[magic[0] : magic[0] + len(magic[1])] != magic[1]:
+        return "not a valid file of its type"
+    return None
+
+
+def check_files(
+    checks: Iterable[FileCheck], workers: Optional[int] = None
+) -> List[Tuple[FileCheck, str]]:
+    """Check files in parallel, over several processes.
+
+    :param checks: the files to check
+    :param workers: number of processes (defaults to the number of CPUs)
+    :returns: the bad files, with what is wrong with them
+    """
+    checks = list(checks)
+    if not checks:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(check_file, checks, chunksize=16)
+        return [(check, problem) for check, problem in zip(checks, results) if problem]
@@ -0,0 +1,68 @@
+"""Walking paginated Flickr listings."""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Generic, Iterable, Iterator, Optional, TypeVar, cast
+
+from flickr_api.objects import FlickrList
+
+T = TypeVar("T")
+
+# Maximum number of listing pages fetched at the same time
+MAX_PAGE_FETCHES = 8
+
+
+class PrefetchWalker(Generic[T]):
+    """Walks along paginated results like flickr_api's Walker, but fetches the following pages
+    in the background while the current one is being iterated.
+
+    The first page is fetched when the walker is created, as it tells how many pages there are.
+    """
+
+    def __init__(
+        self,
+        method: Callable[..., FlickrList],
+        *args: Any,
+        prefetch: Optional[int] = 1,
+        **kwargs: Any,
+    ) -> None:
+        """
+        :param method: method returning a FlickrList
+        :param args: positional arguments to call method with
+        :param prefetch: number of pages to fetch ahead, or None to fetch all the remaining pages
+            at once
+        :param kwargs: named arguments to call method with
+        """
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self._first = method(*args, **kwargs)
+        self._info = self._first.info
+        self._prefetch = prefetch
+
+    def __len__(self) -> int:
+        return int(self._info.total)
+
+    def __iter__(self) -> Iterator[T]:
+        pages = int(self._info.pages)
+        ahead = pages if self._prefetch is None else max(1, self._prefetch)
+
+        next_page = 2
+        pending: Deque["Future[FlickrList]"] = deque()
+        executor = ThreadPoolExecutor(
+            max_workers=min(ahead, MAX_PAGE_FETCHES), thread_name_prefix="listing"
+        )
+        try:
+            page = self._first
+            while True:
+                # Queue up the following pages before handing out the current one
+                while next_page <= pages and len(pending) < ahead:
+                    kwargs = dict(self.kwargs, page=next_page)
+                    pending.append(executor.submit(self.method, *self.args, **kwargs))
+                    next_page += 1
+                yield from cast(Iterable[T], page)
+                if not pending:
+                    return
+                page = pending.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
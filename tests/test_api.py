@@ -0,0 +1,151 @@
+"""Tests for flickr_download.api module."""
+
+from typing import List, Optional, Tuple
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+from flickr_api import method_call
+from flickr_api.flickrerrors import FlickrTimeoutError
+
+from flickr_download import api
+from flickr_download.cache import pack_value
+
+
+class TestRequestObservers:
+    """Tests for the observed API requests."""
+
+    def test_install(self) -> None:
+        """install() replaces flickr_api's request function, and memoizes call_api."""
+        with (
+            patch.object(method_call, "_make_request_with_retry", Mock()),
+            patch.object(method_call, "call_api", Mock()),
+        ):
+            api.install()
+            assert method_call._make_request_with_retry is api._make_request_with_retry
+            assert isinstance(method_call.call_api, api.CountedCall)
+            assert method_call.call_api.call_api is api.get_memo()
+            api.install()
+            assert method_call.call_api.call_api is api.get_memo()
+
+    @patch("requests.Session.post")
+    def test_observers_see_every_request(self, mock_post: Mock) -> None:
+        """Observers are called with the method, status and duration of each request."""
+        seen: List[Tuple[str, Optional[int], float]] = []
+
+        def observer(method: str, status: Optional[int], seconds: float) -> None:
+            seen.append((method, status, seconds))
+
+        mock_post.return_value = Mock(status_code=200)
+        api.add_request_observer(observer)
+        try:
+            resp = api._make_request_with_retry(
+                "https://api.flickr.com/services/rest/", {"method": "flickr.test.echo"}, None
+            )
+            assert resp.status_code == 200
+
+            mock_post.side_effect = requests.ConnectionError()
+            with patch("flickr_api.retry.time.sleep"), pytest.raises(FlickrTimeoutError):
+                api._make_request_with_retry(
+                    "https://api.flickr.com/services/rest/", {"method": "flickr.test.echo"}, None
+                )
+        finally:
+            api.remove_request_observer(observer)
+
+        assert seen[0][:2] == ("flickr.test.echo", 200)
+        assert len(seen) > 1
+        assert all(status is None for _, status, _ in seen[1:])
+
+
+class TestApiBudget:
+    """Tests for the API call budget."""
+
+    @patch("flickr_download.api.time.sleep")
+    def test_budget_waits_when_used_up(self, mock_sleep: Mock) -> None:
+        """Calls are free until the burst is spent, and then wait for the bucket to refill."""
+        budget = api.ApiBudget(3600)
+        for _ in range(60):
+            budget.acquire()
+        mock_sleep.assert_not_called()
+        assert budget.remaining() == 3540
+
+        budget.acquire()
+        budget.acquire()
+        waits = [args[0] for args, _ in mock_sleep.call_args_list]
+        assert waits == [pytest.approx(1, abs=0.1), pytest.approx(2, abs=0.1)]
+
+    def test_budget_holds_an_hour(self) -> None:
+        """No hour has more calls than the budget, the first one included."""
+        clock = [0.0]
+
+        def sleep(seconds: float) -> None:
+            clock[0] += seconds
+
+        with patch("flickr_download.api.time", monotonic=lambda: clock[0], sleep=sleep):
+            budget = api.ApiBudget(3600)
+            calls = 0
+            while True:
+                budget.acquire()
+                if clock[0] > 3600:
+                    break
+                calls += 1
+        assert 3500 < calls <= 3600
+
+    @patch("flickr_download.api.time.sleep")
+    def test_budget_estimates_photos(self, mock_sleep: Mock) -> None:
+        """The remaining budget is turned into a number of photos."""
+        budget = api.ApiBudget(100)
+        assert budget.photos_covered() is None
+        for _ in range(10):
+            budget.acquire()
+        budget.note_photo()
+        budget.note_photo()
+        assert budget.photos_covered() == 18
+        assert "enough for about 18 more photos and 20 photos per hour" in budget.status()
+
+    @patch("requests.Session.post")
+    def test_requests_use_budget(self, mock_post: Mock) -> None:
+        """Every API request takes a call from the budget."""
+        mock_post.return_value = Mock(status_code=200)
+        api.set_budget(10)
+        try:
+            api._make_request_with_retry(
+                "https://api.flickr.com/services/rest/", {"method": "flickr.test.echo"}, None
+            )
+            budget = api.get_budget()
+            assert budget is not None
+            assert budget.calls == 1
+        finally:
+            api.set_budget(None)
+        assert api.get_budget() is None
+
+
+class TestCallMemo:
+    """Tests for the memo of API calls about single photos."""
+
+    def test_memo_reuses_photo_answers(self) -> None:
+        """Calls about the same photo are made once, other calls every time."""
+        call_api = Mock(side_effect=lambda **args: {"photo": {"id": args.get("photo_id")}})
+        memo = api.CallMemo(call_api)
+
+        first = memo(method="flickr.photos.getSizes", photo_id="1", auth_handler=Mock())
+        first["photo"]["id"] = "changed"
+        again = memo(method="flickr.photos.getSizes", photo_id="1", auth_handler=Mock())
+        memo(method="flickr.photos.getSizes", photo_id="2")
+        memo(method="flickr.photos.getInfo", photo_id="1")
+        memo(method="flickr.photosets.getPhotos", photoset_id="1")
+        memo(method="flickr.photosets.getPhotos", photoset_id="1")
+
+        assert again == {"photo": {"id": "1"}}
+        assert call_api.call_count == 5
+        assert memo.saved == 1
+
+    def test_memo_drops_least_recently_used(self) -> None:
+        """The memo keeps at most max_bytes of answers."""
+        call_api = Mock(return_value={"stat": "ok"})
+        memo = api.CallMemo(call_api, max_bytes=2 * len(pack_value({"stat": "ok"})))
+        for photo_id in ["1", "2", "1", "3", "1", "2"]:
+            memo(method="flickr.photos.getInfo", photo_id=photo_id)
+
+        assert call_api.call_count == 4
+        assert memo.saved == 2
@@ -0,0 +1,196 @@
+"""Tests for flickr_download.cache module."""
+
+import pickle
+import sqlite3
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+from unittest.mock import patch
+
+import requests
+
+from flickr_download.cache import (
+    DEFAULT_TTLS,
+    CACHE_FORMAT,
+    SqliteCache,
+    normalize_key,
+    open_cache,
+    pack_value,
+)
+
+
+def test_cache_round_trip() -> None:
+    """Entries survive reopening the cache, and expire on their own."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "cache.db")
+        cache = SqliteCache(path)
+        cache.set("key", {"stat": "ok"})
+        cache.set("expired", "value", timeout=-1)
+        assert cache.get("key") == {"stat": "ok"}
+        assert cache.get("expired") is None
+        assert cache.get("missing", "default") == "default"
+        cache.close()
+
+        cache = SqliteCache(path)
+        assert "key" in cache
+        assert len(cache) == 1
+        cache.delete("key")
+        assert "key" not in cache
+        cache.close()
+
+
+def _response(status: int, content: bytes) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = content
+    return resp
+
+
+def test_cache_skips_errors() -> None:
+    """Error responses are not cached, as they are mostly transient."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = SqliteCache(str(Path(tmpdir) / "cache.db"))
+        cache.set("ok", _response(200, b'{"stat": "ok"}'))
+        cache.set("fail", _response(200, b'{"stat": "fail", "code": 105}'))
+        cache.set("throttled", _response(429, b"Too Many Requests"))
+        cache.set("xml", _response(200, b'<rsp stat="ok"></rsp>'))
+        assert cache.get("ok").json() == {"stat": "ok"}
+        assert cache.get("fail") is None
+        assert cache.get("throttled") is None
+        assert cache.get("xml") is not None
+        cache.close()
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    """Beyond max_bytes, the least recently used entries are evicted."""
+    max_bytes = 2 * len(pack_value(1))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = SqliteCache(str(Path(tmpdir) / "cache.db"), max_bytes=max_bytes)
+        cache.set("a", 1)
+        time.sleep(0.01)
+        cache.set("b", 2)
+        time.sleep(0.01)
+        assert cache.get("a") == 1
+        time.sleep(0.01)
+        cache.set("c", 3)
+        cache.close()
+
+        cache = SqliteCache(str(Path(tmpdir) / "cache.db"), max_bytes=max_bytes)
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        cache.close()
+
+
+def test_open_cache_imports_pickle() -> None:
+    """A pickled cache is imported once, and kept aside."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "cache"
+        database = {
+            "storage": {"fresh": "value", "stale": "old"},
+            "expire_info": {"fresh": time.time() + 60, "stale": time.time() - 60},
+        }
+        with path.open("wb") as handle:
+            pickle.dump(database, handle)
+
+        cache = open_cache(str(path))
+        assert cache.get("fresh") == "value"
+        assert cache.get("stale") is None
+        cache.close()
+        assert Path(tmpdir, "cache.pickle").exists()
+
+        cache = open_cache(str(path))
+        assert len(cache) == 1
+        cache.close()
+
+
+def test_cache_timeout_by_method() -> None:
+    """Responses expire after a time depending on their API method."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = SqliteCache(
+            str(Path(tmpdir) / "cache.db"), timeout=100, ttls={"flickr.photos.getInfo": 5}
+        )
+        sizes = urllib.parse.urlencode({"method": "flickr.photos.getSizes", "photo_id": "1"})
+        info = urllib.parse.urlencode({"method": "flickr.photos.getInfo", "photo_id": "1"})
+        other = urllib.parse.urlencode({"method": "flickr.test.echo"})
+        assert cache.get_timeout(sizes) == DEFAULT_TTLS["flickr.photos.getSizes"]
+        assert cache.get_timeout(info) == 5
+        assert cache.get_timeout(other) == 100
+        cache.close()
+
+
+def test_normalize_key_drops_signing() -> None:
+    """Signed requests for the same call by the same user share a key."""
+
+    def key(nonce: str, token: str, reverse: bool = False) -> str:
+        args = [
+            ("method", "flickr.photos.getInfo"),
+            ("photo_id", "1"),
+            ("format", "json"),
+            ("oauth_nonce", nonce),
+            ("oauth_timestamp", nonce),
+            ("oauth_signature", nonce),
+            ("oauth_consumer_key", "key"),
+            ("oauth_token", token),
+        ]
+        return urllib.parse.urlencode(list(reversed(args)) if reverse else args)
+
+    assert normalize_key(key("1", "alice")) == normalize_key(key("2", "alice", reverse=True))
+    assert normalize_key(key("1", "alice")) != normalize_key(key("1", "bob"))
+    assert "alice" not in normalize_key(key("1", "alice"))
+
+
+def test_cache_hit_ratios() -> None:
+    """The cache counts hits and lookups by API method."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = SqliteCache(str(Path(tmpdir) / "cache.db"))
+        info = urllib.parse.urlencode({"method": "flickr.photos.getInfo", "photo_id": "1"})
+        cache.get(info)
+        cache.set(info, "response")
+        cache.get(info)
+        cache.get(info)
+        assert cache.hit_ratios() == [("flickr.photos.getInfo", 2, 3)]
+        cache.close()
+
+
+def test_cache_emptied_on_format_change() -> None:
+    """A cache in another format is emptied when opened."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "cache.db")
+        cache = SqliteCache(path)
+        cache.set("key", "value")
+        cache.close()
+
+        with patch("flickr_download.cache.CACHE_FORMAT", CACHE_FORMAT + 1):
+            cache = SqliteCache(path)
+            assert cache.get("key") is None
+            cache.close()
+
+
+def test_cache_shared_between_processes() -> None:
+    """Caches opened on the same file see each other's entries, and do without writing when
+    another process holds the lock for too long.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "cache.db")
+        first = SqliteCache(path)
+        second = SqliteCache(path)
+        first.set("a", 1)
+        second.set("b", 2)
+        assert second.get("a") == 1
+        assert first.get("b") == 2
+
+        other = sqlite3.connect(path)
+        other.execute("BEGIN IMMEDIATE")
+        first._conn.execute("PRAGMA busy_timeout = 100")
+        first.set("c", 3)
+        assert first.get("a") == 1
+        other.rollback()
+        other.close()
+
+        assert first.get("c") is None
+        first.set("c", 3)
+        assert second.get("c") == 3
+        first.close()
+        second.close()
@@ -0,0 +1,68 @@
+"""Tests for flickr_download.dedupe module."""
+
+import os
+import tempfile
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import pytest
+
+from flickr_download.dedupe import PhotoIndex, get_index, set_index
+from flickr_download.engines import Resolved
+from flickr_download.flick_download import _transfer_photo
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "symlink"])
+def test_photo_index_links_downloaded_photos(mode: str) -> None:
+    """The index finds the files photos were downloaded to, and links to them."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = PhotoIndex(str(Path(tmpdir) / "index.db"), mode)
+        os.mkdir(Path(tmpdir) / "Set A")
+        os.mkdir(Path(tmpdir) / "Set B")
+        source = Path(tmpdir) / "Set A" / "photo.jpg"
+        source.write_bytes(b"photo")
+        index.add("1", None, str(source))
+
+        assert index.find("1", None) == str(source)
+        assert index.find("1", "Large") is None
+        target = Path(tmpdir) / "Set B" / "photo.jpg"
+        assert index.link(str(source), str(target))
+        assert target.read_bytes() == b"photo"
+        assert target.is_symlink() == (mode == "symlink")
+        assert not index.link(str(source), str(target))
+        assert index.linked == 1
+
+        source.unlink()
+        assert index.find("1", None) is None
+        index.close()
+
+
+def test_photo_index_unknown_mode() -> None:
+    """Only the link modes are supported."""
+    with pytest.raises(ValueError):
+        PhotoIndex(":memory:", "reflink")
+
+
+def test_transfer_photo_links_photos_downloaded_before() -> None:
+    """With an index, a photo downloaded before is linked instead of downloaded again."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = PhotoIndex(str(Path(tmpdir) / "index.db"))
+        photo = Mock(id="1")
+        photo.__getitem__ = Mock(return_value=None)
+        photo.get = Mock(return_value=None)
+        first = str(Path(tmpdir) / "first.jpg")
+        second = str(Path(tmpdir) / "second.jpg")
+
+        set_index(index)
+        try:
+            with patch("flickr_download.flick_download.download_file") as mock_download_file:
+                mock_download_file.side_effect = lambda url, fname: Path(fname).write_bytes(b"1")
+                assert _transfer_photo(photo, Resolved(first, "url"), None)
+                assert _transfer_photo(photo, Resolved(second, "url"), None)
+        finally:
+            set_index(None)
+            index.close()
+
+        mock_download_file.assert_called_once_with("url", first)
+        assert os.path.samefile(first, second)
+        assert get_index() is None
@@ -0,0 +1,217 @@
+"""Tests for flickr_download.engines module."""
+
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from flickr_download.engines import (
+    AdaptiveEngine,
+    AsyncEngine,
+    Engine,
+    PipelineEngine,
+    Resolved,
+    SharedEngine,
+    ThreadEngine,
+)
+from flickr_download.transfer import download_file
+
+
+def _resolve(
+    photo: Mock, fname: str, size_label: Optional[str], skip_download: bool, save_json: bool
+) -> Optional[Resolved]:
+    if photo.id == "missing":
+        return None
+    if photo.id == "exists":
+        return Resolved(fname + ".jpg", None)
+    return Resolved(fname + ".jpg", f"https://live.staticflickr.com/{photo.id}.jpg")
+
+
+@pytest.mark.parametrize(
+    "make_engine",
+    [
+        lambda transfer: ThreadEngine(_resolve, transfer, 4),
+        lambda transfer: AsyncEngine(_resolve, transfer, per_host=4),
+        lambda transfer: PipelineEngine(_resolve, transfer, 2, 3),
+    ],
+    ids=["thread", "async", "pipeline"],
+)
+def test_engine_results(make_engine: Callable[..., Engine]) -> None:
+    """Both engines transfer only what needs transferring and report the outcome."""
+    transferred: List[str] = []
+
+    def transfer(photo: Mock, resolved: Resolved, size_label: Optional[str]) -> bool:
+        transferred.append(resolved.fname)
+        return photo.id != "fails"
+
+    engine = make_engine(transfer)
+    try:
+        futures = {
+            photo_id: engine.submit(Mock(id=photo_id), photo_id, None, False, False)
+            for photo_id in ["1", "missing", "exists", "fails"]
+        }
+        results = {photo_id: future.result() for photo_id, future in futures.items()}
+    finally:
+        engine.shutdown()
+
+    assert results == {"1": True, "missing": False, "exists": True, "fails": False}
+    assert sorted(transferred) == ["1.jpg", "fails.jpg"]
+
+
+@pytest.mark.parametrize(
+    "make_engine",
+    [
+        lambda transfer: ThreadEngine(_resolve, transfer, 4),
+        lambda transfer: AsyncEngine(_resolve, transfer, per_host=4),
+        lambda transfer: PipelineEngine(_resolve, transfer, 2, 3),
+    ],
+    ids=["thread", "async", "pipeline"],
+)
+def test_engine_shutdown_cancels(make_engine: Callable[..., Engine]) -> None:
+    """Shutting down with cancel gives up on the downloads not started yet."""
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def transfer(photo: Mock, resolved: Resolved, size_label: Optional[str]) -> bool:
+        started.release()
+        return release.wait(5)
+
+    engine = make_engine(transfer)
+    try:
+        futures = [engine.submit(Mock(id=str(i)), str(i), None, False, False) for i in range(10)]
+        assert started.acquire(timeout=5)
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        engine.shutdown(cancel=True)
+        timer.join()
+    finally:
+        release.set()
+
+    assert any(future.cancelled() for future in futures)
+    assert all(future.done() for future in futures)
+
+
+def test_async_engine_caps_requests_per_host() -> None:
+    """AsyncEngine never runs more than per_host transfers to one host at a time."""
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def transfer(photo: Mock, resolved: Resolved, size_label: Optional[str]) -> bool:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        return True
+
+    engine = AsyncEngine(_resolve, transfer, per_host=2)
+    try:
+        futures = [engine.submit(Mock(id=str(i)), str(i), None, False, False) for i in range(10)]
+        assert all(future.result() for future in futures)
+    finally:
+        engine.shutdown()
+
+    assert max_running == 2
+
+
+def test_shared_engine_splits_in_flight_budget() -> None:
+    """SharedEngine gives each attached list an equal share of the engine."""
+    engine = ThreadEngine(_resolve, Mock(return_value=True), 4)
+    shared = SharedEngine(engine)
+    try:
+        assert shared.max_in_flight == 8
+        with shared.attach():
+            assert shared.max_in_flight == 8
+            with shared.attach():
+                assert shared.max_in_flight == 4
+            assert shared.max_in_flight == 8
+        assert shared.call(sum, [1, 2, 3]).result() == 6
+    finally:
+        engine.shutdown()
+
+
+def test_pipeline_engine_stats() -> None:
+    """PipelineEngine counts the items through each stage and the queue depths."""
+    engine = PipelineEngine(_resolve, Mock(return_value=True), 1, 1)
+    try:
+        futures = [
+            engine.submit(Mock(id=photo_id), photo_id, None, False, False)
+            for photo_id in ["1", "2", "exists", "missing"]
+        ]
+        assert [future.result() for future in futures] == [True, True, True, False]
+        assert engine.call(len, "abc").result() == 3
+    finally:
+        engine.shutdown()
+
+    assert engine.resolve_stats.processed == 5
+    assert engine.transfer_stats.processed == 2
+    assert engine.resolve_stats.max_queue_depth <= engine.resolve_stats.queue_size == 2
+    assert "Transfer stage: 2 items" in engine.transfer_stats.summary(1.0)
+
+
+def test_adaptive_engine_aimd() -> None:
+    """AdaptiveEngine grows the limit on healthy requests and halves it on throttling."""
+    engine = AdaptiveEngine(ThreadEngine(_resolve, Mock(return_value=True), 4), cooldown=60)
+    try:
+        assert engine.max_in_flight == 1
+        for _ in range(5):
+            engine.observe("flickr.photos.getSizes", 200, 0.1)
+        assert engine.max_in_flight == 6
+
+        # Slow requests hold the limit, 4xx other than 429 are ignored
+        engine.observe("flickr.photos.getSizes", 200, 1.0)
+        engine.observe("flickr.photos.getSizes", 404, 0.1)
+        assert engine.max_in_flight == 6
+
+        engine.observe("flickr.photos.getSizes", 429, 0.1)
+        assert engine.max_in_flight == 3
+        # Within the cooldown, further errors are part of the same burst
+        engine.observe("flickr.photos.getSizes", None, 0.1)
+        assert engine.max_in_flight == 3
+
+        # Out of slow start, the limit grows by about one per round trip
+        for _ in range(4):
+            engine.observe("flickr.photos.getSizes", 200, 0.1)
+        assert engine.max_in_flight == 4
+
+        for _ in range(100):
+            engine.observe("flickr.photos.getSizes", 200, 0.1)
+        assert engine.max_in_flight == 8
+    finally:
+        engine.shutdown()
+
+
+@patch("requests.Session.get")
+def test_adaptive_engine_grows_on_transfers(mock_get: MagicMock) -> None:
+    """AdaptiveEngine grows the limit on healthy transfers, without any API request."""
+
+    def get(url: str, **kwargs: object) -> MagicMock:
+        time.sleep(0.01)
+        resp = MagicMock(status_code=200, headers={"Content-Length": "5"})
+        resp.__enter__.return_value = resp
+        resp.iter_content.return_value = [b"photo"]
+        return resp
+
+    mock_get.side_effect = get
+
+    def transfer(photo: Mock, resolved: Resolved, size_label: Optional[str]) -> bool:
+        assert resolved.url
+        download_file(resolved.url, resolved.fname)
+        return True
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = AdaptiveEngine(ThreadEngine(_resolve, transfer, 16))
+        try:
+            for i in range(50):
+                fname = str(Path(tmpdir) / str(i))
+                assert engine.submit(Mock(id=str(i)), fname, None, False, False).result()
+            assert engine.max_in_flight == 32
+        finally:
+            engine.shutdown()
@@ -1,21 +1,42 @@
 """Tests for flickr_download.flick_download module."""
 
+import argparse
 import os
+import sqlite3
 import tempfile
+import threading
+import time
 from pathlib import Path
 from typing import Optional
 from unittest.mock import Mock, patch
 
+import pytest
 import requests.exceptions
 from flickr_api.flickrerrors import FlickrAPIError, FlickrError
+from flickr_api.objects import Photo
 
+from flickr_download.engines import AdaptiveEngine, Resolved, SharedEngine
+from flickr_download.filename_handlers import INCREMENT_INDEX, title_increment
 from flickr_download.flick_download import (
+    METADATA_SCHEMA_VERSION,
+    SkipSet,
+    _get_engine,
+    _get_listing_extension,
+    _get_listing_extras,
     _get_metadata_db,
+    _in_shard,
+    _is_downloaded,
     _load_defaults,
+    _parse_shard,
+    _record_download,
     do_download_photo,
     download_list,
+    download_user,
     find_user,
+    merge_shards,
+    verify_downloads,
 )
+from flickr_download.transfer import SavedFile
 
 
 class TestFindUser:
@@ -150,11 +171,203 @@ class TestMetadataDb:
 
             conn.close()
 
+    def test_get_metadata_db_migrates_unversioned_store(self) -> None:
+        """_get_metadata_db drops duplicate records of old stores, and indexes the downloads."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old = sqlite3.connect(Path(tmpdir) / ".metadata.db")
+            old.execute("CREATE TABLE downloads (photo_id text, size_label text, suffix text)")
+            old.executemany(
+                "INSERT INTO downloads VALUES (?, ?, ?)",
+                [("1", "", ""), ("1", "", ""), ("2", "", "")],
+            )
+            old.commit()
+            old.close()
+
+            conn = _get_metadata_db(tmpdir)
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == METADATA_SCHEMA_VERSION
+            assert conn.execute("SELECT COUNT(*) FROM downloads").fetchone()[0] == 2
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN SELECT 1 FROM downloads"
+                " WHERE photo_id = ? AND size_label = ? AND suffix = ?",
+                ("1", "", ""),
+            ).fetchall()
+            assert "downloads_key" in str(plan)
+            conn.close()
+
+    @patch("flickr_download.flick_download.METADATA_COMMIT_RECORDS", 3)
+    def test_record_download_commits_in_batches(self) -> None:
+        """Downloads are committed in batches, and when closing the metadata store."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conn = _get_metadata_db(tmpdir)
+            reader = sqlite3.connect(Path(tmpdir) / ".metadata.db")
+
+            def committed() -> int:
+                return int(reader.execute("SELECT COUNT(*) FROM downloads").fetchone()[0])
+
+            for photo_id in ["1", "2", "3", "4"]:
+                _record_download(conn, Mock(id=photo_id), None, "")
+            _record_download(conn, Mock(id="1"), None, "")
+            assert committed() == 3
+            conn.close()
+            assert committed() == 4
+            reader.close()
+
+    def test_record_download_does_not_block_other_connections(self) -> None:
+        """Pending records don't keep other connections from writing, and are written once
+        their time is up even without new records.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conn = _get_metadata_db(tmpdir)
+            with patch("flickr_download.flick_download.METADATA_COMMIT_SECONDS", 0.05):
+                _record_download(conn, Mock(id="1"), None, "")
+            assert _is_downloaded(conn, Mock(id="1"), None, "")
+
+            other = sqlite3.connect(Path(tmpdir) / ".metadata.db", timeout=0.01)
+            other.execute("BEGIN IMMEDIATE")
+            other.rollback()
+
+            deadline = time.monotonic() + 5
+            while not other.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            other.close()
+            conn.close()
+
+
+class TestVerifyDownloads:
+    """Tests for verify_downloads function."""
+
+    def test_verify_downloads_forgets_bad_files(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Bad files are set aside and forgotten, so that their set is downloaded again."""
+        jpeg = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            os.mkdir("Test Set")
+            conn = _get_metadata_db("Test Set")
+            for photo_id, content in [("1", jpeg), ("2", jpeg[:50])]:
+                path = os.path.join("Test Set", f"{photo_id}.jpg")
+                Path(path).write_bytes(content)
+                _record_download(conn, Mock(id=photo_id), None, "", SavedFile(path, len(jpeg)))
+            conn.execute("INSERT INTO album_state VALUES ('set', '', '', 'fingerprint')")
+            conn.close()
+
+            assert verify_downloads(".", workers=1) == 1
+
+            assert Path("Test Set", "1.jpg").exists()
+            assert not Path("Test Set", "2.jpg").exists()
+            assert Path("Test Set", "2.jpg.bad").read_bytes() == jpeg[:50]
+            conn = _get_metadata_db("Test Set")
+            assert [row[0] for row in conn.execute("SELECT photo_id FROM downloads")] == ["1"]
+            assert [row[0] for row in conn.execute("SELECT photo_id FROM files")] == ["1"]
+            assert conn.execute("SELECT * FROM album_state").fetchone() is None
+            conn.close()
+
+
+class TestSkipSet:
+    """Tests for the skip set of already downloaded photos."""
+
+    def test_skip_set_from_metadata_db(self) -> None:
+        """The skip set has the downloads recorded in the metadata store."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conn = _get_metadata_db(tmpdir)
+            _record_download(conn, Mock(id="1"), "Large", " (Large)")
+            skip_set = SkipSet.from_metadata_db(conn)
+            conn.close()
+
+        assert skip_set.has_download(Mock(id="1"), "Large", " (Large)")
+        assert not skip_set.has_download(Mock(id="1"), None, "")
+        assert not skip_set.has_file("1", ".jpg")
+
+    def test_skip_set_from_directory(self) -> None:
+        """The skip set has the files of the directory, but not the .json files."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / "Photo.jpg").touch()
+            (Path(tmpdir) / "Other.jpg.json").touch()
+            skip_set = SkipSet.from_directory(tmpdir)
+
+        assert skip_set.has_file("Test Set/Photo", ".jpg")
+        assert skip_set.has_file("Photo.jpg", None)
+        assert not skip_set.has_file("Photo", ".mp4")
+        assert not skip_set.has_file("Photo", None)
+        assert not skip_set.has_file("Other", ".jpg")
+        assert not skip_set.has_file("Other.jpg", ".jpg")
+
+    def test_skip_set_from_directory_title_with_dot(self) -> None:
+        """A file named after a title with a dot in it only matches that title."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / "Day 1. Arrival").touch()
+            skip_set = SkipSet.from_directory(tmpdir)
+
+        assert skip_set.has_file("Test Set/Day 1. Arrival", None)
+        assert not skip_set.has_file("Test Set/Day 1", ".jpg")
+
+    def test_get_listing_extension(self) -> None:
+        """The extension comes from the URL of the size in the listing, or is .mp4 for videos."""
+
+        def photo(**extras: str) -> Mock:
+            return Mock(get=Mock(side_effect=lambda key, *args: extras.get(key)))
+
+        assert _get_listing_extension(photo(media="video"), None) == ".mp4"
+        assert _get_listing_extension(photo(media="photo", url_o="https://a/1_o.png"), None) == (
+            ".png"
+        )
+        assert _get_listing_extension(photo(media="photo", url_l="https://a/1_b.jpg"), "Large") == (
+            ".jpg"
+        )
+        assert _get_listing_extension(photo(media="photo"), None) is None
+        assert _get_listing_extension(photo(), None) is None
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download._transfer_photo")
+    @patch("flickr_download.flick_download._resolve_photo")
+    def test_download_list_skips_existing_files(
+        self,
+        mock_resolve: Mock,
+        mock_transfer: Mock,
+        mock_walker: Mock,
+        workers: int,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """Without a metadata store, photos with a file on disk are skipped without resolving
+        them. The file has to have the extension the photo gets, a video is not skipped for a
+        photo of the same name.
+        """
+
+        def photo(photo_id: str, **extras: str) -> Mock:
+            return Mock(id=photo_id, get=Mock(side_effect=lambda key, *args: extras.get(key)))
+
+        photos = [
+            photo("0", media="photo", url_o="https://live.staticflickr.com/0_o.jpg"),
+            photo("1", media="photo", url_o="https://live.staticflickr.com/1_o.jpg"),
+            photo("2", media="video"),
+        ]
+        mock_walker.return_value = iter(photos)
+        mock_resolve.side_effect = lambda photo, fname, *args: Resolved(fname, "url")
+        mock_transfer.return_value = True
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            os.mkdir("Test Album")
+            (Path("Test Album") / "1.jpg").touch()
+            (Path("Test Album") / "2.jpg").touch()
+
+            download_list(
+                Mock(),
+                "Test Album",
+                lambda pset, photo, suffix: str(photo.id),
+                None,
+                workers=workers,
+            )
+
+        assert sorted(call.args[0].id for call in mock_resolve.call_args_list) == ["0", "2"]
+
 
 class TestDoDownloadPhoto:
     """Tests for do_download_photo function."""
 
-    def test_skip_already_downloaded_with_metadata_db(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_skip_already_downloaded_with_metadata_db(self, mock_download_file: Mock) -> None:
         """do_download_photo skips photos already in metadata db."""
         with tempfile.TemporaryDirectory() as tmpdir:
             # Set up metadata db with existing download
@@ -168,7 +381,6 @@ class TestDoDownloadPhoto:
             mock_photo = Mock()
             mock_photo.id = "123"
             mock_photo.title = "Test Photo"
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -187,10 +399,11 @@ class TestDoDownloadPhoto:
                 metadata_db=conn,
             )
 
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
             conn.close()
 
-    def test_skip_existing_file(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_skip_existing_file(self, mock_download_file: Mock) -> None:
         """do_download_photo skips if file already exists."""
         with tempfile.TemporaryDirectory() as tmpdir:
             # Create existing file
@@ -202,7 +415,6 @@ class TestDoDownloadPhoto:
             mock_photo.title = "Test Photo"
             mock_photo.__getitem__ = Mock(return_value=True)  # loaded = True
             mock_photo._getOutputFilename = Mock(return_value=str(existing_file))
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -220,10 +432,13 @@ class TestDoDownloadPhoto:
             )
 
             # Should not call save since file exists
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
     @patch("flickr_download.flick_download.set_file_time")
-    def test_download_photo_saves_file(self, mock_set_file_time: Mock) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_download_photo_saves_file(
+        self, mock_download_file: Mock, mock_set_file_time: Mock
+    ) -> None:
         """do_download_photo saves new photo."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -239,7 +454,6 @@ class TestDoDownloadPhoto:
             )
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock()
             mock_photo.get = Mock(return_value=None)
 
             mock_pset = Mock()
@@ -257,14 +471,18 @@ class TestDoDownloadPhoto:
                 mock_get_filename,
             )
 
-            mock_photo.save.assert_called_once()
+            mock_download_file.assert_called_once()
 
     @patch("flickr_download.flick_download.set_file_time")
-    def test_download_photo_records_in_metadata_db(self, mock_set_file_time: Mock) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_download_photo_records_in_metadata_db(
+        self, mock_download_file: Mock, mock_set_file_time: Mock
+    ) -> None:
         """do_download_photo records download in metadata db."""
         with tempfile.TemporaryDirectory() as tmpdir:
             conn = _get_metadata_db(tmpdir)
             target_file = Path(tmpdir) / "Test Photo.jpg"
+            mock_download_file.return_value = SavedFile(str(target_file), 5, "abc")
 
             mock_photo = Mock()
             mock_photo.id = "456"
@@ -277,7 +495,6 @@ class TestDoDownloadPhoto:
             )
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock()
             mock_photo.get = Mock(return_value=None)
 
             mock_pset = Mock()
@@ -296,13 +513,19 @@ class TestDoDownloadPhoto:
                 metadata_db=conn,
             )
 
-            # Verify recorded in db
+            # Verify recorded in db, once written
+            conn.flush()
             cursor = conn.execute("SELECT * FROM downloads WHERE photo_id = ?", ("456",))
             row = cursor.fetchone()
             assert row == ("456", "Large", " (Large)")
+            cursor = conn.execute(
+                "SELECT path, size, sha256 FROM files WHERE photo_id = ?", ("456",)
+            )
+            assert cursor.fetchone() == ("Test Photo.jpg", 5, "abc")
             conn.close()
 
-    def test_skip_download_flag(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_skip_download_flag(self, mock_download_file: Mock) -> None:
         """do_download_photo respects skip_download flag."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -318,7 +541,6 @@ class TestDoDownloadPhoto:
             )
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock()
             mock_photo.get = Mock(return_value=None)
 
             mock_pset = Mock()
@@ -338,7 +560,7 @@ class TestDoDownloadPhoto:
             )
 
             # Should not call save with skip_download=True
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
 
 class TestDownloadList:
@@ -402,6 +624,392 @@ class TestDownloadList:
             finally:
                 os.chdir(original_cwd)
 
+    @pytest.mark.parametrize("engine", ["sync", "async", "pipeline"])
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download._transfer_photo")
+    @patch("flickr_download.flick_download._resolve_photo")
+    def test_download_list_parallel(
+        self, mock_resolve: Mock, mock_transfer: Mock, mock_walker: Mock, engine: str
+    ) -> None:
+        """download_list with workers names photos in listing order and records downloads."""
+        photos = [Mock(id=str(i)) for i in range(10)]
+        mock_walker.return_value = iter(photos)
+        mock_resolve.side_effect = lambda photo, fname, *args: Resolved(
+            fname, f"https://live.staticflickr.com/{photo.id}.jpg"
+        )
+        mock_transfer.side_effect = lambda photo, *args: photo.id != "3"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            original_cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                names = []
+
+                def mock_get_filename(pset: object, photo: Mock, suffix: Optional[str]) -> str:
+                    names.append(photo.id)
+                    return photo.id
+
+                download_list(
+                    Mock(),
+                    "Test Album",
+                    mock_get_filename,
+                    None,
+                    metadata_store=True,
+                    workers=4,
+                    engine=engine,
+                )
+
+                assert names == [photo.id for photo in photos]
+                assert mock_transfer.call_count == 10
+                conn = _get_metadata_db("Test Album")
+                recorded = {row[0] for row in conn.execute("SELECT photo_id FROM downloads")}
+                conn.close()
+                assert recorded == {photo.id for photo in photos} - {"3"}
+            finally:
+                os.chdir(original_cwd)
+
+    @pytest.mark.parametrize("engine", ["sync", "async", "pipeline"])
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download._transfer_photo")
+    @patch("flickr_download.flick_download._resolve_photo")
+    def test_download_list_parallel_same_file_name(
+        self,
+        mock_resolve: Mock,
+        mock_transfer: Mock,
+        mock_walker: Mock,
+        engine: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """Photos saved to the same file name are not in flight together, and only the first
+        one is saved, as for a serial download.
+        """
+        mock_walker.return_value = iter([Mock(id=str(i)) for i in range(4)])
+        mock_resolve.side_effect = lambda photo, fname, *args: Resolved(
+            fname, None if os.path.exists(fname) else "url"
+        )
+        in_flight = []
+        lock = threading.Lock()
+
+        def transfer(photo: Mock, resolved: Resolved, size_label: Optional[str]) -> bool:
+            with lock:
+                in_flight.append(photo.id)
+                overlapping = len(in_flight) > 1
+            time.sleep(0.05)
+            Path(resolved.fname).touch()
+            with lock:
+                in_flight.remove(photo.id)
+            return not overlapping
+
+        mock_transfer.side_effect = transfer
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            download_list(
+                Mock(),
+                "Test Album",
+                lambda pset, photo, suffix: "Same title",
+                None,
+                metadata_store=True,
+                workers=4,
+                engine=engine,
+            )
+
+            assert [call.args[0].id for call in mock_transfer.call_args_list] == ["0"]
+            conn = _get_metadata_db("Test Album")
+            assert conn.execute("SELECT COUNT(*) FROM downloads").fetchone()[0] == 4
+            conn.close()
+
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download.do_download_photo")
+    def test_download_list_incremental(
+        self, mock_do_download: Mock, mock_walker: Mock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """Incremental downloads list the photos uploaded since the last complete download."""
+
+        def photo(upload_date: str) -> Mock:
+            return Mock(get=Mock(side_effect=lambda k, *args: {"dateupload": upload_date}.get(k)))
+
+        def run(*results: bool) -> None:
+            mock_do_download.side_effect = list(results)
+            mock_walker.return_value = [photo("100"), photo("300"), photo("200")][: len(results)]
+            download_list(
+                Mock(id="user"),
+                "Photostream",
+                lambda pset, photo, suffix: "test",
+                None,
+                metadata_store=True,
+                incremental=True,
+            )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+
+            run(True, True, True)
+            assert "min_upload_date" not in mock_walker.call_args.kwargs
+
+            # A photo failing to download keeps the watermark where it was
+            run(True, True, False)
+            assert mock_walker.call_args.kwargs["min_upload_date"] == 300
+            run(True)
+            assert mock_walker.call_args.kwargs["min_upload_date"] == 300
+
+            # Unless doing a full rescan
+            mock_do_download.side_effect = None
+            download_list(
+                Mock(id="user"),
+                "Photostream",
+                lambda pset, photo, suffix: "test",
+                None,
+                metadata_store=True,
+            )
+            assert "min_upload_date" not in mock_walker.call_args.kwargs
+
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download.do_download_photo", return_value=True)
+    def test_download_list_skips_unchanged_sets(
+        self, mock_do_download: Mock, mock_walker: Mock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """Sets unchanged since their last complete download are not listed again."""
+
+        def run(date_update: str) -> None:
+            info = {"photos": 2, "videos": 0, "date_update": date_update}
+            mock_walker.return_value = [Mock(), Mock()]
+            download_list(
+                Mock(id="set", get=Mock(side_effect=lambda k, *args: info.get(k))),
+                "Test Album",
+                lambda pset, photo, suffix: "test",
+                None,
+                metadata_store=True,
+                skip_unchanged=True,
+            )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+
+            run("1000")
+            run("1000")
+            assert mock_walker.call_count == 1
+
+            run("2000")
+            assert mock_walker.call_count == 2
+
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download._process_photo")
+    def test_download_list_commits_when_interrupted(
+        self, mock_process: Mock, mock_walker: Mock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """The downloads recorded before an interruption are committed."""
+        mock_walker.return_value = [Mock(id="1"), Mock(id="2")]
+        mock_process.side_effect = [True, KeyboardInterrupt]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            with pytest.raises(KeyboardInterrupt):
+                download_list(
+                    Mock(),
+                    "Test Album",
+                    lambda pset, photo, suffix: photo.id,
+                    None,
+                    metadata_store=True,
+                )
+
+            reader = sqlite3.connect(Path("Test Album", ".metadata.db"))
+            assert reader.execute("SELECT photo_id FROM downloads").fetchall() == [("1",)]
+            reader.close()
+
+    @patch("flickr_download.flick_download._get_engine")
+    def test_download_list_cancels_engine_when_interrupted(
+        self, mock_get_engine: Mock, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """An interrupted download gives up on the photos its engine did not start yet."""
+        engine = mock_get_engine.return_value
+        engine.call.side_effect = KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            with pytest.raises(KeyboardInterrupt):
+                download_list(Mock(), "Test Album", lambda *args: "test", None, workers=4)
+
+        engine.shutdown.assert_called_once_with(cancel=True)
+
+        engine.reset_mock()
+        engine.call.side_effect = None
+        engine.call.return_value.result.return_value = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            download_list(Mock(), "Test Album", lambda *args: "test", None, workers=4)
+
+        engine.shutdown.assert_called_once_with()
+
+
+class TestGetEngine:
+    """Tests for _get_engine function."""
+
+    def test_adaptive_async_engine_bounded_by_workers(self) -> None:
+        """The adaptive limit of the async engine is bounded by the workers, not by the photos
+        it holds in flight.
+        """
+        engine = _get_engine("async", 4, adaptive=True)
+        assert isinstance(engine, AdaptiveEngine)
+        try:
+            for _ in range(100):
+                engine.observe("flickr.photos.getSizes", 200, 0.1)
+            assert engine.max_in_flight == 4
+        finally:
+            engine.shutdown()
+
+
+class TestDownloadUser:
+    """Tests for download_user function."""
+
+    @patch("flickr_download.flick_download.download_list")
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download.find_user")
+    def test_download_user_parallel_shares_engine(
+        self, mock_find_user: Mock, mock_walker: Mock, mock_download_list: Mock
+    ) -> None:
+        """download_user with workers downloads all sets on one shared engine."""
+        photosets = [Mock(id=str(i), title=f"Set {i}") for i in range(5)]
+        mock_walker.return_value = iter(photosets)
+
+        def mock_get_filename(pset: object, photo: object, suffix: Optional[str]) -> str:
+            return "test"
+
+        download_user("someuser", mock_get_filename, None, workers=3)
+
+        assert mock_download_list.call_count == 5
+        downloaded = {call.args[0] for call in mock_download_list.call_args_list}
+        assert downloaded == set(photosets)
+        engines = {call.args[8] for call in mock_download_list.call_args_list}
+        assert len(engines) == 1
+        assert isinstance(engines.pop(), SharedEngine)
+
+    @patch("flickr_download.flick_download.download_list")
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download.find_user")
+    def test_download_user_parallel_interrupted(
+        self, mock_find_user: Mock, mock_walker: Mock, mock_download_list: Mock
+    ) -> None:
+        """An interruption stops the sets being downloaded, and the sets not started yet."""
+        mock_walker.return_value = iter([Mock(id=str(i), title=f"Set {i}") for i in range(10)])
+        started = threading.Event()
+        downloaded = []
+        stopped = []
+
+        def download(photoset: Mock, *args: object, **kwargs: object) -> None:
+            downloaded.append(photoset.id)
+            if photoset.id == "0":
+                assert started.wait(5)
+                raise KeyboardInterrupt
+            started.set()
+            engine = args[7]
+            assert isinstance(engine, SharedEngine)
+            try:
+                while True:
+                    engine.call(time.sleep, 0.01).result()
+            finally:
+                stopped.append(photoset.id)
+
+        mock_download_list.side_effect = download
+
+        with pytest.raises(KeyboardInterrupt):
+            download_user("someuser", lambda *args: "test", None, workers=2)
+
+        deadline = time.monotonic() + 5
+        while len(stopped) < len(downloaded) - 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert "1" in stopped
+        assert len(downloaded) < 10
+
+    """Tests for sharded downloads."""
+
+    def test_in_shard_partitions_photos(self) -> None:
+        """Every photo belongs to exactly one shard."""
+        photos = [Mock(id=str(1000 + i)) for i in range(100)]
+        for photo in photos:
+            assert sum(_in_shard(photo, (k, 3)) for k in range(1, 4)) == 1
+        assert all(_in_shard(photo, None) for photo in photos)
+
+    def test_parse_shard(self) -> None:
+        """_parse_shard parses K/N and rejects invalid shards."""
+        assert _parse_shard("2/4") == (2, 4)
+        for value in ["0/4", "5/4", "2", "a/b"]:
+            with pytest.raises(argparse.ArgumentTypeError):
+                _parse_shard(value)
+
+    @patch("flickr_download.flick_download.Walker")
+    @patch("flickr_download.flick_download._transfer_photo", return_value=True)
+    @patch("flickr_download.flick_download._resolve_photo")
+    def test_sharded_download_names_and_merge(
+        self, mock_resolve: Mock, mock_transfer: Mock, mock_walker: Mock
+    ) -> None:
+        """Shards agree on title_increment names, and merge_shards finds them complete."""
+        photos = [Mock(id=str(i), title="Same") for i in range(12)]
+        mock_walker.side_effect = lambda *args, **kwargs: list(photos)
+        names = {}
+
+        def resolve(photo: Mock, fname: str, *args: object) -> Resolved:
+            names[photo.id] = fname
+            return Resolved(fname, "https://live.staticflickr.com/1.jpg")
+
+        mock_resolve.side_effect = resolve
+        pset = Mock(id="set")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            original_cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                assert merge_shards(pset, "Test Album", 2, None) == 12
+
+                for index in (1, 2):
+                    INCREMENT_INDEX.clear()
+                    download_list(
+                        pset,
+                        "Test Album",
+                        title_increment,
+                        None,
+                        metadata_store=True,
+                        shard=(index, 2),
+                    )
+                    if index == 1:
+                        assert 0 < len(names) < 12
+                        assert merge_shards(pset, "Test Album", 2, None) == 12 - len(names)
+
+                assert merge_shards(pset, "Test Album", 2, None) == 0
+            finally:
+                os.chdir(original_cwd)
+                INCREMENT_INDEX.clear()
+
+        expected = ["Same"] + [f"Same({i})" for i in range(1, 12)]
+        assert [Path(names[photo.id]).name for photo in photos] == expected
+
+    @patch("flickr_download.flick_download.Walker")
+    def test_merge_shards_copies_files(self, mock_walker: Mock, tmp_path: Path) -> None:
+        """The files the shards saved photos to are merged too, and verified from there."""
+        mock_walker.return_value = [Mock(id="1")]
+        jpeg = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+        dirname = tmp_path / "Test Album"
+        dirname.mkdir()
+        (dirname / "1.jpg").write_bytes(jpeg[:50])
+        conn = _get_metadata_db(str(dirname), (1, 2))
+        _record_download(conn, Mock(id="1"), None, "", SavedFile("1.jpg", len(jpeg), None))
+        conn.close()
+
+        with patch("flickr_download.flick_download.get_dirname", return_value=str(dirname)):
+            assert merge_shards(Mock(id="set"), "Test Album", 2, None) == 0
+        conn = _get_metadata_db(str(dirname))
+        assert conn.execute("SELECT * FROM files").fetchall() == [
+            ("1", "", "", "1.jpg", len(jpeg), None)
+        ]
+        conn.close()
+
+        assert verify_downloads(str(tmp_path), workers=1) == 1
+        for shard in [None, (1, 2)]:
+            conn = _get_metadata_db(str(dirname), shard)
+            assert conn.execute("SELECT * FROM downloads").fetchone() is None
+            conn.close()
+
 
 def _create_mock_photo(
     photo_id: str = "123",
@@ -427,7 +1035,8 @@ def _create_mock_photo(
 class TestDoDownloadPhotoErrorHandling:
     """Tests for error handling in do_download_photo function."""
 
-    def test_ioerror_on_save_is_handled(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_ioerror_on_save_is_handled(self, mock_download_file: Mock) -> None:
         """do_download_photo handles IOError during save gracefully."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -435,7 +1044,7 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo = _create_mock_photo()
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock(side_effect=IOError("Connection refused"))
+            mock_download_file.side_effect = IOError("Connection refused")
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -453,15 +1062,16 @@ class TestDoDownloadPhotoErrorHandling:
                 mock_get_filename,
             )
 
-    def test_flickrerror_on_save_is_handled(self) -> None:
-        """do_download_photo handles FlickrError during save gracefully."""
+    @patch("flickr_download.flick_download.download_file")
+    def test_flickrerror_on_photo_file_is_handled(self, mock_download_file: Mock) -> None:
+        """do_download_photo handles FlickrError getting the URL to download gracefully."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
 
             mock_photo = _create_mock_photo()
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock(side_effect=FlickrError("API Error"))
+            mock_photo.getPhotoFile = Mock(side_effect=FlickrError("API Error"))
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -479,7 +1089,10 @@ class TestDoDownloadPhotoErrorHandling:
                 mock_get_filename,
             )
 
-    def test_connection_error_on_save_is_handled(self) -> None:
+            mock_download_file.assert_not_called()
+
+    @patch("flickr_download.flick_download.download_file")
+    def test_connection_error_on_save_is_handled(self, mock_download_file: Mock) -> None:
         """do_download_photo handles ConnectionError during save gracefully.
 
         ConnectionError inherits from OSError, which is aliased as IOError in Python 3.
@@ -490,8 +1103,8 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo = _create_mock_photo()
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
-            mock_photo.save = Mock(
-                side_effect=requests.exceptions.ConnectionError("Failed to resolve hostname")
+            mock_download_file.side_effect = requests.exceptions.ConnectionError(
+                "Failed to resolve hostname"
             )
 
             mock_pset = Mock()
@@ -510,7 +1123,10 @@ class TestDoDownloadPhotoErrorHandling:
                 mock_get_filename,
             )
 
-    def test_connection_error_on_get_output_filename_is_handled(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_connection_error_on_get_output_filename_is_handled(
+        self, mock_download_file: Mock
+    ) -> None:
         """do_download_photo handles ConnectionError during _getOutputFilename.
 
         This is the fix for issue #166 - network errors during metadata retrieval
@@ -521,7 +1137,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo._getOutputFilename = Mock(
                 side_effect=requests.exceptions.ConnectionError("Failed to resolve hostname")
             )
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -540,9 +1155,12 @@ class TestDoDownloadPhotoErrorHandling:
             )
 
             # Save should not be called since we return early after error
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
-    def test_connection_error_on_get_largest_size_label_is_handled(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_connection_error_on_get_largest_size_label_is_handled(
+        self, mock_download_file: Mock
+    ) -> None:
         """do_download_photo handles ConnectionError during _getLargestSizeLabel.
 
         Network errors when checking video size labels are now caught.
@@ -555,7 +1173,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo._getLargestSizeLabel = Mock(
                 side_effect=requests.exceptions.ConnectionError("Failed to resolve hostname")
             )
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -574,9 +1191,10 @@ class TestDoDownloadPhotoErrorHandling:
             )
 
             # Save should not be called since we return early after error
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
-    def test_connection_error_on_photo_load_is_handled(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_connection_error_on_photo_load_is_handled(self, mock_download_file: Mock) -> None:
         """do_download_photo handles ConnectionError during photo.load().
 
         Network errors like ConnectionError (which inherit from OSError)
@@ -590,7 +1208,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo.load = Mock(
                 side_effect=requests.exceptions.ConnectionError("Failed to resolve hostname")
             )
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -609,9 +1226,10 @@ class TestDoDownloadPhotoErrorHandling:
             )
 
             # Save should not be called since we return early after error
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
-    def test_flickrerror_on_photo_load_is_handled(self) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_flickrerror_on_photo_load_is_handled(self, mock_download_file: Mock) -> None:
         """do_download_photo handles FlickrError during photo.load() gracefully."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -619,7 +1237,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo = _create_mock_photo(loaded=False)
             mock_photo._getOutputFilename = Mock(return_value=str(target_file))
             mock_photo.load = Mock(side_effect=FlickrError("Photo not found"))
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -638,10 +1255,13 @@ class TestDoDownloadPhotoErrorHandling:
             )
 
             # Save should not be called since we return early after FlickrError
-            mock_photo.save.assert_not_called()
+            mock_download_file.assert_not_called()
 
     @patch("flickr_download.flick_download.set_file_time")
-    def test_flickr_api_error_permission_denied_on_exif(self, mock_set_file_time: Mock) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_flickr_api_error_permission_denied_on_exif(
+        self, mock_download_file: Mock, mock_set_file_time: Mock
+    ) -> None:
         """do_download_photo handles permission denied error on getExif gracefully."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -651,7 +1271,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
             # Error code 2 means "Permission denied" for EXIF
             mock_photo.getExif = Mock(side_effect=FlickrAPIError(2, "Permission denied"))
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -671,7 +1290,10 @@ class TestDoDownloadPhotoErrorHandling:
             )
 
     @patch("flickr_download.flick_download.set_file_time")
-    def test_flickr_api_error_other_code_on_exif_raises(self, mock_set_file_time: Mock) -> None:
+    @patch("flickr_download.flick_download.download_file")
+    def test_flickr_api_error_other_code_on_exif_raises(
+        self, mock_download_file: Mock, mock_set_file_time: Mock
+    ) -> None:
         """do_download_photo re-raises non-permission FlickrAPIError on getExif."""
         with tempfile.TemporaryDirectory() as tmpdir:
             target_file = Path(tmpdir) / "Test Photo.jpg"
@@ -681,7 +1303,6 @@ class TestDoDownloadPhotoErrorHandling:
             mock_photo._getLargestSizeLabel = Mock(return_value="Original")
             # Error code 99 is some other error
             mock_photo.getExif = Mock(side_effect=FlickrAPIError(99, "Unknown error"))
-            mock_photo.save = Mock()
 
             mock_pset = Mock()
             mock_pset.title = "Test Set"
@@ -700,3 +1321,93 @@ class TestDoDownloadPhotoErrorHandling:
                 mock_get_filename,
                 save_json=True,
             )
+
+
+class TestListingExtras:
+    """Tests for downloading photos from the extras of their listing."""
+
+    def _listing_photo(self, **extras: str) -> Photo:
+        return Photo(
+            id="123",
+            title="Test Photo",
+            media="photo",
+            datetaken="2020-01-02 03:04:05",
+            **extras,
+        )
+
+    def test_listing_extras(self) -> None:
+        """The listing asks for the URL of the size to download."""
+        assert _get_listing_extras(None) == "media,date_upload,date_taken,url_o"
+        assert _get_listing_extras("Large") == "media,date_upload,date_taken,url_o,url_l"
+
+    @patch("flickr_download.flick_download.set_file_time")
+    @patch("flickr_download.flick_download.download_file")
+    @patch("flickr_api.method_call.call_api")
+    def test_download_from_listing(
+        self,
+        mock_call_api: Mock,
+        mock_download_file: Mock,
+        mock_set_file_time: Mock,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """A photo with the original URL in its listing is downloaded without API calls."""
+        photo = self._listing_photo(
+            url_o="https://live.staticflickr.com/1/123_abc_o.jpg",
+            width_o="4000",
+            height_o="3000",
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            do_download_photo(
+                "Test Set", Mock(), photo, None, "", lambda pset, photo, suffix: "Test Photo"
+            )
+
+            mock_call_api.assert_not_called()
+            mock_download_file.assert_called_once_with(
+                "https://live.staticflickr.com/1/123_abc_o.jpg",
+                os.path.join("Test Set", "Test Photo.jpg"),
+            )
+            mock_set_file_time.assert_called_once_with(
+                os.path.join("Test Set", "Test Photo.jpg"), "2020-01-02 03:04:05"
+            )
+
+    @patch("flickr_download.flick_download.set_file_time")
+    @patch("flickr_download.flick_download.download_file")
+    @patch("flickr_api.method_call.call_api")
+    def test_missing_size_falls_back(
+        self,
+        mock_call_api: Mock,
+        mock_download_file: Mock,
+        mock_set_file_time: Mock,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """Sizes missing from the listing are fetched with flickr.photos.getSizes."""
+        mock_call_api.return_value = {
+            "sizes": {
+                "size": [
+                    {
+                        "label": "Large",
+                        "width": "1024",
+                        "height": "768",
+                        "source": "https://live.staticflickr.com/1/123_abc_b.jpg",
+                        "media": "photo",
+                    }
+                ]
+            }
+        }
+        photo = self._listing_photo(
+            url_o="https://live.staticflickr.com/1/123_abc_o.jpg",
+            width_o="4000",
+            height_o="3000",
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.chdir(tmpdir)
+            do_download_photo(
+                "Test Set", Mock(), photo, "Large", "", lambda pset, photo, suffix: "Test Photo"
+            )
+
+            assert mock_call_api.call_args.kwargs["method"] == "flickr.photos.getSizes"
+            mock_download_file.assert_called_once_with(
+                "https://live.staticflickr.com/1/123_abc_b.jpg",
+                os.path.join("Test Set", "Test Photo.jpg"),
+            )
@@ -0,0 +1,51 @@
+"""Tests for flickr_download.sessions module."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+
+from flickr_download import sessions
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> Iterator[str]:
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_session_reuses_connections(server: str) -> None:
+    """Requests to the same host share a kept-alive connection, and are counted."""
+    sessions.set_pool_size(4)
+    try:
+        session = sessions.get_session()
+        assert sessions.get_session() is session
+        assert session.get_adapter(server)._pool_maxsize == 4  # type: ignore[attr-defined]
+        for _ in range(3):
+            assert session.get(server).content == b"ok"
+
+        assert sessions.connection_stats() == [("127.0.0.1", 1, 3)]
+        assert sessions.table().splitlines()[1].split() == ["127.0.0.1", "1", "3", "3.0"]
+    finally:
+        sessions.set_pool_size(sessions.DEFAULT_POOL_SIZE)
+    assert sessions.connection_stats() == []
@@ -0,0 +1,66 @@
+"""Tests for flickr_download.stats module."""
+
+import json
+import tempfile
+from pathlib import Path
+
+from flickr_download.stats import ApiStats
+
+
+def _stats() -> ApiStats:
+    stats = ApiStats()
+    for _ in range(3):
+        stats.count_call("flickr.photos.getSizes", error=False)
+    stats.count_call("flickr.photos.getSizes", error=True)
+    stats.count_memo_hit("flickr.photos.getSizes")
+    stats.count_fetch("flickr.photos.getSizes")
+    stats.count_fetch("flickr.photos.getSizes")
+    stats.count_request("flickr.photos.getSizes", 200, 0.05)
+    stats.count_request("flickr.photos.getSizes", 500, 0.3)
+    stats.count_request("flickr.photos.getSizes", 200, 20.0)
+    return stats
+
+
+def test_snapshot() -> None:
+    """The counters are kept by API method, with the cache hits of the cache."""
+    snapshot = _stats().snapshot(
+        [("flickr.photos.getSizes", 1, 3), ("flickr.people.getInfo", 1, 1)]
+    )
+
+    sizes = snapshot["flickr.photos.getSizes"]
+    assert sizes["calls"] == 4
+    assert sizes["errors"] == 1
+    assert sizes["memo_hits"] == 1
+    assert (sizes["cache_hits"], sizes["cache_misses"]) == (1, 2)
+    assert (sizes["requests"], sizes["failed_requests"], sizes["retries"]) == (3, 1, 1)
+    assert sizes["latency"]["<0.1s"] == 1
+    assert sizes["latency"]["<0.5s"] == 1
+    assert sizes["latency"][">=10.0s"] == 1
+    assert sizes["p50"] == 0.5
+    assert sizes["p90"] == float("inf")
+    assert snapshot["flickr.people.getInfo"]["cache_hits"] == 1
+
+
+def test_table_and_json() -> None:
+    """The counters are shown as a table, and written as JSON."""
+    stats = _stats()
+    table = stats.table().splitlines()
+    assert table[0].startswith("API method")
+    assert table[1].split() == [
+        "flickr.photos.getSizes",
+        "4",
+        "1",
+        "0/0",
+        "3",
+        "1",
+        "1",
+        "<0.5s",
+        ">=10.0s",
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "stats.json"
+        stats.write_json(str(path))
+        written = json.loads(path.read_text())
+    assert written["flickr.photos.getSizes"]["calls"] == 4
+    assert written["flickr.photos.getSizes"]["p90"] is None
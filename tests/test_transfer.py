@@ -0,0 +1,202 @@
+"""Tests for flickr_download.transfer module."""
+
+import hashlib
+import json
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+import requests
+
+from flickr_download.transfer import (
+    PART_INFO_SUFFIX,
+    PART_SUFFIX,
+    IncompleteDownload,
+    TransferStats,
+    add_transfer_observer,
+    download_file,
+    remove_transfer_observer,
+    set_options,
+)
+
+
+def _response(status: int, body: bytes, headers: Optional[Dict[str, str]] = None) -> MagicMock:
+    resp = MagicMock(status_code=status, headers=headers or {})
+    resp.__enter__.return_value = resp
+    resp.iter_content.return_value = [body]
+    return resp
+
+
+def _write_part(
+    fname: str,
+    content: bytes,
+    url: str = "url",
+    validator: str = '"etag"',
+    preallocated: bool = False,
+) -> None:
+    Path(fname + PART_SUFFIX).write_bytes(content)
+    Path(fname + PART_SUFFIX + PART_INFO_SUFFIX).write_text(
+        json.dumps({"url": url, "validator": validator, "preallocated": preallocated})
+    )
+
+
+@patch("requests.Session.get")
+def test_download_file(mock_get: MagicMock) -> None:
+    """The file is renamed into place once complete."""
+    mock_get.return_value = _response(200, b"photo", {"Content-Length": "5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        saved = download_file("url", fname)
+        assert saved == (fname, 5, hashlib.sha256(b"photo").hexdigest())
+        assert Path(fname).read_bytes() == b"photo"
+        assert not Path(fname + PART_SUFFIX).exists()
+    assert "Range" not in mock_get.call_args.kwargs["headers"]
+
+
+@patch("requests.Session.get")
+def test_download_file_incomplete(mock_get: MagicMock) -> None:
+    """A transfer shorter than announced is kept as a partial file."""
+    mock_get.return_value = _response(200, b"pho", {"Content-Length": "5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        with pytest.raises(IncompleteDownload):
+            download_file("url", fname)
+        assert not Path(fname).exists()
+        assert Path(fname + PART_SUFFIX).read_bytes() == b"pho"
+
+
+@patch("requests.Session.get")
+def test_download_file_resumes(mock_get: MagicMock) -> None:
+    """A partial file is resumed with a Range request, if the file did not change since."""
+    mock_get.return_value = _response(206, b"to", {"Content-Range": "bytes 3-4/5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        _write_part(fname, b"pho")
+        saved = download_file("url", fname)
+        assert saved.sha256 == hashlib.sha256(b"photo").hexdigest()
+        assert Path(fname).read_bytes() == b"photo"
+        assert not Path(fname + PART_SUFFIX + PART_INFO_SUFFIX).exists()
+    assert mock_get.call_args.kwargs["headers"]["Range"] == "bytes=3-"
+    assert mock_get.call_args.kwargs["headers"]["If-Range"] == '"etag"'
+
+
+@patch("requests.Session.get")
+def test_download_file_restarts_other_file(mock_get: MagicMock) -> None:
+    """A partial file from another URL, or from an unknown one, is downloaded again. The URL and
+    the validator of the file are kept until it is complete.
+    """
+    headers = {"Content-Length": "5", "ETag": 'W/"weak"', "Last-Modified": "Sat, 17 Oct 2026"}
+    mock_get.return_value = _response(200, b"pho", headers)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        _write_part(fname, b"xyz", url="other")
+        with pytest.raises(IncompleteDownload):
+            download_file("url", fname)
+        assert "Range" not in mock_get.call_args.kwargs["headers"]
+        info = json.loads(Path(fname + PART_SUFFIX + PART_INFO_SUFFIX).read_text())
+        assert info == {"url": "url", "validator": "Sat, 17 Oct 2026", "preallocated": False}
+
+        Path(fname + PART_SUFFIX + PART_INFO_SUFFIX).unlink()
+        mock_get.return_value = _response(200, b"photo", {"Content-Length": "5"})
+        download_file("url", fname)
+        assert "Range" not in mock_get.call_args.kwargs["headers"]
+        assert Path(fname).read_bytes() == b"photo"
+
+
+@patch("requests.Session.get")
+def test_download_file_range_ignored(mock_get: MagicMock) -> None:
+    """A server sending the whole file again overwrites the partial file, and all of it is
+    counted as transferred.
+    """
+    mock_get.return_value = _response(200, b"photo", {"Content-Length": "5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        _write_part(fname, b"pho")
+        with patch("flickr_download.transfer._STATS") as stats:
+            saved = download_file("url", fname)
+        assert saved == (fname, 5, hashlib.sha256(b"photo").hexdigest())
+        assert Path(fname).read_bytes() == b"photo"
+    assert stats.count.call_args.args[1] == 5
+
+
+@patch("requests.Session.get")
+def test_download_file_already_complete(mock_get: MagicMock) -> None:
+    """A partial file that turns out complete is renamed into place."""
+    mock_get.return_value = _response(416, b"", {"Content-Range": "bytes */5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        _write_part(fname, b"photo")
+        assert download_file("url", fname).size == 5
+        assert Path(fname).read_bytes() == b"photo"
+
+
+@patch("requests.Session.get")
+def test_download_file_options(mock_get: MagicMock) -> None:
+    """Files are written in chunks of the size set, and preallocated on request. Preallocated
+    partial files are not resumed, and only keep what was written.
+    """
+    mock_get.return_value = _response(200, b"pho", {"Content-Length": "5"})
+    set_options(chunk_size=4096, preallocate=True)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = str(Path(tmpdir) / "photo.jpg")
+            Path(fname + PART_SUFFIX).write_bytes(b"p")
+            with pytest.raises(IncompleteDownload):
+                download_file("url", fname)
+            assert Path(fname + PART_SUFFIX).read_bytes() == b"pho"
+            info = json.loads(Path(fname + PART_SUFFIX + PART_INFO_SUFFIX).read_text())
+            assert not info["preallocated"]
+    finally:
+        set_options()
+
+    assert "Range" not in mock_get.call_args.kwargs["headers"]
+    mock_get.return_value.iter_content.assert_called_once_with(4096)
+
+
+@patch("requests.Session.get")
+def test_download_file_restarts_preallocated(mock_get: MagicMock) -> None:
+    """A partial file left preallocated by a crash is not taken as complete."""
+    mock_get.return_value = _response(200, b"photo", {"Content-Length": "5"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = str(Path(tmpdir) / "photo.jpg")
+        _write_part(fname, b"\0" * 5, preallocated=True)
+        assert download_file("url", fname).size == 5
+        assert Path(fname).read_bytes() == b"photo"
+    assert "Range" not in mock_get.call_args.kwargs["headers"]
+
+
+def test_transfer_stats() -> None:
+    """The throughput is shown by host, slowest first."""
+    stats = TransferStats()
+    assert not stats
+    stats.count("fast.example.com", 4 * 1024 * 1024, 1.0)
+    stats.count("slow.example.com", 1024 * 1024, 2.0)
+    stats.count("slow.example.com", 1024 * 1024, 2.0)
+
+    lines = stats.table().splitlines()
+    assert lines[1].split() == ["slow.example.com", "2", "2.0", "0.50"]
+    assert lines[2].split() == ["fast.example.com", "1", "4.0", "4.00"]
+
+
+@patch("requests.Session.get")
+def test_download_file_observed(mock_get: MagicMock) -> None:
+    """Observers get the host and the status of every transfer request."""
+    observer = Mock()
+    add_transfer_observer(observer)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = str(Path(tmpdir) / "photo.jpg")
+            mock_get.return_value = _response(200, b"photo", {"Content-Length": "5"})
+            download_file("https://live.staticflickr.com/1.jpg", fname)
+            mock_get.side_effect = requests.ConnectionError
+            with pytest.raises(requests.ConnectionError):
+                download_file("https://live.staticflickr.com/2.jpg", fname)
+    finally:
+        remove_transfer_observer(observer)
+
+    assert [call.args[:2] for call in observer.call_args_list] == [
+        ("live.staticflickr.com", 200),
+        ("live.staticflickr.com", None),
+    ]
@@ -1,18 +1,14 @@
 import os
 import sys
-import tempfile
-from pathlib import Path
 from unittest.mock import MagicMock, Mock, patch
 
 import pytest
 from flickr_api.objects import Person, Tag
 from flickr_download.utils import (
-    get_cache,
     get_dirname,
     get_filename,
     get_full_path,
     get_photo_page,
-    save_cache,
     serialize_json,
     set_file_time,
 )
@@ -58,29 +54,6 @@ def test_set_file_time_overflow() -> None:
         mocked.assert_not_called()
 
 
-def test_get_cache_no_file() -> None:
-    """get_cache returns empty cache when file doesn't exist."""
-    cache = get_cache("/nonexistent/path/cache.pkl")
-    assert cache.storage == {}
-
-
-def test_save_and_get_cache() -> None:
-    """save_cache and get_cache round-trip works."""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        cache_path = str(Path(tmpdir) / "test_cache.pkl")
-
-        # Get fresh cache and add data
-        cache = get_cache(cache_path)
-        cache.storage["test_key"] = "test_value"
-        cache.expire_info["test_key"] = 9999999999
-
-        # Save and reload
-        save_cache(cache_path, cache)
-        loaded_cache = get_cache(cache_path)
-
-        assert loaded_cache.storage["test_key"] == "test_value"
-
-
 def test_serialize_json_person() -> None:
     """serialize_json handles Person objects."""
     person = Mock(spec=Person)
@@ -0,0 +1,41 @@
+"""Tests for flickr_download.verify module."""
+
+import hashlib
+import tempfile
+from pathlib import Path
+
+from flickr_download.verify import FileCheck, check_file, check_files
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+
+
+def test_check_file() -> None:
+    """Files are checked for their size, checksum and type."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "photo.jpg")
+        Path(path).write_bytes(JPEG)
+        sha256 = hashlib.sha256(JPEG).hexdigest()
+
+        assert check_file(FileCheck(path, len(JPEG), sha256)) is None
+        assert check_file(FileCheck(path, None, None)) is None
+        assert check_file(FileCheck(path, len(JPEG) + 1, sha256)) == "104 bytes instead of 105"
+        assert check_file(FileCheck(path, len(JPEG), "0" * 64)) == "checksum mismatch"
+        assert check_file(FileCheck(path + ".missing", None, None)) == "missing"
+
+        Path(path).write_bytes(b"<html>" + JPEG[6:])
+        assert check_file(FileCheck(path, len(JPEG), None)) == "not a valid file of its type"
+        # The checksum is trusted over the file type
+        sha256 = hashlib.sha256(b"<html>" + JPEG[6:]).hexdigest()
+        assert check_file(FileCheck(path, len(JPEG), sha256)) is None
+
+
+def test_check_files() -> None:
+    """check_files returns the bad files, checked in other processes."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        good = FileCheck(str(Path(tmpdir) / "good.jpg"), len(JPEG), None)
+        Path(good.path).write_bytes(JPEG)
+        bad = FileCheck(str(Path(tmpdir) / "bad.jpg"), len(JPEG), None)
+        Path(bad.path).write_bytes(JPEG[:10])
+
+        assert check_files([good, bad], workers=2) == [(bad, "10 bytes instead of 104")]
+        assert check_files([]) == []
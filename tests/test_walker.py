@@ -0,0 +1,57 @@
+"""Tests for flickr_download.walker module."""
+
+import threading
+from typing import Any, List
+from unittest.mock import Mock
+
+import pytest
+from flickr_api.objects import FlickrList
+
+from flickr_download.walker import PrefetchWalker
+
+PAGES = 5
+PER_PAGE = 3
+
+
+def _get_photos(page: int = 1, **kwargs: Any) -> FlickrList:
+    info = Mock(pages=PAGES, total=PAGES * PER_PAGE)
+    return FlickrList([(page, i) for i in range(PER_PAGE)], info)
+
+
+@pytest.mark.parametrize("prefetch", [1, 3, None])
+def test_prefetch_walker_yields_all_in_order(prefetch: Any) -> None:
+    """PrefetchWalker returns all items of all pages in listing order."""
+    walker: PrefetchWalker[Any] = PrefetchWalker(_get_photos, prefetch=prefetch)
+
+    assert len(walker) == PAGES * PER_PAGE
+    assert list(walker) == [(page, i) for page in range(1, PAGES + 1) for i in range(PER_PAGE)]
+
+
+def test_prefetch_walker_passes_arguments() -> None:
+    """PrefetchWalker calls the method with the given arguments and the page number."""
+    method = Mock(side_effect=_get_photos)
+
+    list(PrefetchWalker(method, extras="media", prefetch=2))
+
+    pages = sorted(call.kwargs.get("page", 1) for call in method.call_args_list)
+    assert pages == list(range(1, PAGES + 1))
+    assert all(call.kwargs["extras"] == "media" for call in method.call_args_list)
+
+
+def test_prefetch_walker_fetches_ahead() -> None:
+    """PrefetchWalker fetches the next page while the current one is being iterated."""
+    fetched: List[int] = []
+    second_page = threading.Event()
+
+    def get_photos(page: int = 1) -> FlickrList:
+        fetched.append(page)
+        if page == 2:
+            second_page.set()
+        return _get_photos(page)
+
+    walker: PrefetchWalker[Any] = PrefetchWalker(get_photos, prefetch=1)
+    iterator = iter(walker)
+    next(iterator)
+
+    assert second_page.wait(timeout=5)
+    assert fetched == [1, 2]